@@ -1,6 +1,27 @@
+import argparse
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import re
+import select
+import shutil
 import string
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-import nbtlib
+import numpy as np
 
 # ----------------------
 # 配置区
@@ -9,9 +30,126 @@ import nbtlib
 DEFAULT_INPUT_FILE = "1.schem"
 DEFAULT_OUTPUT_ROOT = "multiblock"
 DEFAULT_PACKAGE_NAME = "cn.qiuye.gtl_extend.common.data.machines.MultiBlock"
-DEFAULT_LAYERS_PER_FILE = 100
 DEFAULT_CLASS_PREFIX = "SteamOP"
 DEFAULT_BASE_STRUCTURE = "FactoryBlockPattern.start()"
+DEFAULT_DECODE_CHUNK = 1 << 22  # varint分块解码时每块的字节数
+DEFAULT_WRITE_BUFFER = 1 << 20  # 写出Java文件时的缓冲区大小
+DEFAULT_LAYER_SLAB = 64  # 生成层数据时每次从方块数组中连续拷贝的层数
+DEFAULT_STREAM_THRESHOLD = 32 * 1024 * 1024  # 自动选择流式加载的NBT数据大小（解压后字节数）
+DEFAULT_SPILL_THRESHOLD = 1 << 20  # 流式加载时超过该字节数的数组写入临时内存映射文件
+DEFAULT_STREAM_SKIP_KEYS = {  # 流式加载时跳过的标签
+    "BlockEntities", "TileEntities", "Entities", "entities", "Biomes", "PendingBlockTicks", "PendingFluidTicks", "nbt"
+}
+SCHEMATIC_SUFFIXES = (".schem", ".litematic", ".nbt")  # 批量模式收集的结构文件后缀
+TOOL_VERSION = "1.3.0"  # 生成代码格式变化时需要递增，使旧缓存失效
+
+# 构建缓存配置
+DEFAULT_CACHE_DIR = Path(DEFAULT_OUTPUT_ROOT) / ".cache"
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 缓存总大小上限
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 3600  # 缓存条目最长保留时间（秒）
+CACHE_IGNORED_KEYS = {
+    'INPUT_FILE', 'output_dir', 'jobs', 'cache', 'cache_dir', 'quiet', 'loader', 'clean_output', 'profile',
+    'profile_cprofile', 'verify', 'block_source', 'input_digest'
+}  # 不影响输出内容的配置项
+PARTS_MANIFEST_NAME = ".parts_manifest.json"  # 输出目录中记录各文件内容哈希的清单
+
+DEFAULT_VERIFY_REPORT = 20  # 校验时最多列出的不一致坐标数
+
+# 监视模式配置
+DEFAULT_WATCH_INTERVAL = 1.0  # 轮询间隔（秒），inotify模式下为检查退出信号的间隔
+DEFAULT_WATCH_DEBOUNCE = 0.3  # 收到变化后等待写入完成的时间（秒）
+INOTIFY_MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Java类文件限制（Part拆分依据）
+JAVA_METHOD_CODE_LIMIT = 65535  # 单个方法（静态初始化<clinit>）的字节码上限
+JAVA_CONSTANT_POOL_LIMIT = 65535  # 单个类的常量池条目上限
+JAVA_UTF8_CONSTANT_LIMIT = 65535  # 单个字符串常量的modified UTF-8字节数上限
+PART_BUDGET_RATIO = 0.9  # 只使用上限的一部分，给编译器的额外开销留出余量
+PART_CLASS_POOL_OVERHEAD = 16  # 每个Part类固定占用的常量池条目（类名、父类、String类型、<clinit>等）
+
+# 资源输出模式：层数据写入gzip压缩的游程编码资源文件，由生成的Java加载类在运行时展开
+OUTPUT_MODES = ("java", "resource")
+LAYER_RESOURCE_MAGIC = b"MBLK"
+LAYER_RESOURCE_VERSION = 1
+LAYER_RESOURCE_RUN_DTYPE = np.dtype([('length', '>i4'), ('symbol', '>u2')])  # 与DataInputStream.readInt/readChar对应
+LAYER_LOADER_TEMPLATE = string.Template("""$package_line
+
+import com.gregtechceu.gtceu.api.pattern.FactoryBlockPattern;
+
+import java.io.DataInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.UncheckedIOException;
+import java.util.Arrays;
+import java.util.zip.GZIPInputStream;
+
+public class $class_name {
+
+    private static final String RESOURCE = "$resource_name";
+    private static String[][] layers;
+    private static int[][] aisles;
+
+    private $class_name() {
+    }
+
+    public static FactoryBlockPattern aisles(FactoryBlockPattern pattern) {
+        load();
+        for (int[] aisle : aisles) {
+            pattern = pattern.aisle(layers[aisle[0]]);
+            if (aisle[1] > 1) {
+                pattern = pattern.setRepeatable(aisle[1]);
+            }
+        }
+        return pattern;
+    }
+
+    public static String[] layer(int index) {
+        load();
+        return layers[index];
+    }
+
+    private static synchronized void load() {
+        if (layers != null) {
+            return;
+        }
+        try (InputStream resource = $class_name.class.getResourceAsStream(RESOURCE)) {
+            if (resource == null) {
+                throw new IllegalStateException("Missing structure resource: " + RESOURCE);
+            }
+            DataInputStream in = new DataInputStream(new GZIPInputStream(resource));
+            if (in.readInt() != $magic || in.readInt() != $version) {
+                throw new IllegalStateException("Unsupported structure resource: " + RESOURCE);
+            }
+            String[][] loadedLayers = new String[in.readInt()][];
+            int rowCount = in.readInt();
+            int rowLength = in.readInt();
+            char[] buffer = new char[rowCount * rowLength];
+            for (int i = 0; i < loadedLayers.length; i++) {
+                int runCount = in.readInt();
+                int position = 0;
+                for (int run = 0; run < runCount; run++) {
+                    int length = in.readInt();
+                    Arrays.fill(buffer, position, position + length, in.readChar());
+                    position += length;
+                }
+                String[] rows = new String[rowCount];
+                for (int row = 0; row < rowCount; row++) {
+                    rows[row] = new String(buffer, row * rowLength, rowLength);
+                }
+                loadedLayers[i] = rows;
+            }
+            int[][] loadedAisles = new int[in.readInt()][];
+            for (int i = 0; i < loadedAisles.length; i++) {
+                loadedAisles[i] = new int[] {in.readInt(), in.readInt()};
+            }
+            aisles = loadedAisles;
+            layers = loadedLayers;
+        } catch (IOException e) {
+            throw new UncheckedIOException(e);
+        }
+    }
+}
+""")
 
 # 默认特殊字符配置
 DEFAULT_SPECIAL_CHARS = {
@@ -51,6 +189,13 @@ CHAR_CATEGORIES = [
     ['!', '@', '#', '$', '%', '^', '&', '*', '-', '+', '=']  # 最后：特殊符号
 ]
 
+# 单符号用尽后的扩展字符（均为Java char字面量可表示的BMP字符，写入Java源码时转义为\uXXXX）
+OVERFLOW_CHAR_CATEGORIES = [
+    [chr(code) for code in range(0xC0, 0x100) if code not in (0xD7, 0xF7)],  # Latin-1补充字母
+    [chr(code) for code in range(0x100, 0x180)],  # 拉丁文扩展A
+    [chr(code) for code in range(0xE000, 0xF900)]  # 私用区
+]
+
 
 # ----------------------
 # 用户输入函数
@@ -115,28 +260,1053 @@ def get_user_input():
     }
 
 
+# ----------------------
+# 配置文件与批量输入
+# ----------------------
+def default_config():
+    """返回不含输入文件的默认转换配置"""
+    return {
+        'package_name': DEFAULT_PACKAGE_NAME,
+        'class_prefix': DEFAULT_CLASS_PREFIX,
+        'SPECIAL_CHARS': DEFAULT_SPECIAL_CHARS,
+        'complex_conditions': DEFAULT_COMPLEX_CONDITIONS,
+        'state_rules': None,  # 方块状态保留规则，None表示不在转换时移除方块状态
+        'trim': False,  # 是否裁剪四周全是空气的切片
+        'dedupe_layers': False,  # 是否合并相同的层并折叠连续重复的aisle
+        'layers_per_file': None,  # 每个Part的最大层数，None表示只按Java类文件限制自动拆分
+        'stats': False,  # 是否输出每个字符对应方块及出现次数的统计文件
+        'output_mode': "java",  # java: 层数据写成String[]常量；resource: 写成压缩资源文件和运行时加载类
+        'region': None  # 只转换的区域[x0, y0, z0, x1, y1, z1]（半开区间），None表示整个结构
+    }
+
+
+def structure_name(config):
+    """输出目录和Java包名使用的结构名：默认取输入文件名，分块转换时由config['name']指定"""
+    return config.get('name') or Path(config['INPUT_FILE']).stem
+
+
+def load_config_file(config_path):
+    """从JSON或TOML文件读取转换配置，未填写的项使用默认值"""
+    config_path = Path(config_path)
+    if config_path.suffix.lower() == ".toml":
+        import tomllib
+        with open(config_path, "rb") as config_file:
+            file_config = tomllib.load(config_file)
+    else:
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            file_config = json.load(config_file)
+
+    config = default_config()
+    unknown_keys = sorted(set(file_config) - set(config))
+    if unknown_keys:
+        raise ValueError(f"配置文件 {config_path} 包含未知配置项: {', '.join(unknown_keys)}"
+                         f"（可用配置项: {', '.join(config)}）")
+    config.update(file_config)
+    return config
+
+
+def collect_schematic_files(pattern):
+    """根据目录或通配符收集待转换的结构文件"""
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(file for file in path.iterdir() if file.suffix.lower() in SCHEMATIC_SUFFIXES)
+    return sorted(Path(match) for match in glob.glob(pattern, recursive=True) if Path(match).is_file())
+
+
+# ----------------------
+# 方块数据解码
+# ----------------------
+def decode_varint_array(buffer, count=None, chunk_size=DEFAULT_DECODE_CHUNK, out=None):
+    """将LEB128 varint字节流解码为uint32数组（Sponge v2/v3 BlockData格式）"""
+    raw = np.asarray(buffer).reshape(-1).view(np.uint8)
+    # 已知方块总数时直接写入预分配数组（可为内存映射），避免分块结果再拼接一次
+    if out is None and count is not None:
+        out = np.empty(count, dtype=np.uint32)
+    chunks = []
+    decoded = 0
+    begin = 0
+    while begin < raw.size:
+        chunk = raw[begin:begin + chunk_size]
+
+        # 快速路径：整块都是单字节varint
+        if not (chunk >= 0x80).any():
+            values = chunk
+        else:
+            # 批量路径：按varint结束字节切分，逐字节位批量累加
+            ends = np.flatnonzero(chunk < 0x80)
+            if ends.size == 0:
+                if begin + chunk.size >= raw.size:
+                    raise ValueError("BlockData末尾存在不完整的varint")
+                raise ValueError("BlockData中存在超长varint")
+            chunk = chunk[:ends[-1] + 1]
+            starts = np.empty_like(ends)
+            starts[0] = 0
+            starts[1:] = ends[:-1] + 1
+            lengths = ends - starts + 1
+            max_length = int(lengths.max())
+            if max_length > 5:
+                raise ValueError(f"BlockData中存在超长varint: {max_length}字节")
+
+            values = (chunk[starts] & 0x7F).astype(np.uint32)
+            for shift in range(1, max_length):
+                selected = lengths > shift
+                values[selected] |= (chunk[starts[selected] + shift] & 0x7F).astype(np.uint32) << np.uint32(7 * shift)
+
+        if out is None:
+            chunks.append(values.astype(np.uint32))
+        elif decoded + values.size > out.size:
+            raise ValueError(f"数据长度不匹配！预期: {out.size}, 实际超过预期")
+        else:
+            out[decoded:decoded + values.size] = values
+        decoded += values.size
+        begin += chunk.size
+
+    if out is not None:
+        if decoded != out.size:
+            raise ValueError(f"数据长度不匹配！预期: {out.size}, 实际: {decoded}")
+        return out
+    if not chunks:
+        return np.zeros(0, dtype=np.uint32)
+    return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+
+def decode_block_data_array(block_data_tag, count=None, out=None):
+    """将BlockData标签转换为uint32数组：字节数组按varint解码，整数数组直接转换"""
+    array = np.asarray(block_data_tag).reshape(-1)
+    if array.dtype.itemsize == 1:
+        return decode_varint_array(array, count, out=out)
+    if out is None and array.dtype == np.uint32 and (count is None or array.size == count):
+        # 读取器已解码好的索引数组直接使用
+        return array
+
+    if count is not None and array.size != count:
+        raise ValueError(f"数据长度不匹配！预期: {count}, 实际: {array.size}")
+    if out is None:
+        return array.astype(np.uint32)
+    out[:] = array
+    return out
+
+
+def _varint_lengths(values):
+    """每个uint32值编码为varint后的字节数（1~5）"""
+    lengths = np.ones(values.size, dtype=np.uint8)
+    for shift in (7, 14, 21, 28):
+        lengths += values >= (1 << shift)
+    return lengths
+
+
+def encode_varint_array(values, chunk_size=DEFAULT_DECODE_CHUNK):
+    """将非负整数数组编码为LEB128 varint字节数组（decode_varint_array的逆操作）
+
+    先分块统计总字节数并一次分配结果，再分块编码写入，临时数组大小只与chunk_size有关。
+    """
+    values = np.asarray(values).reshape(-1)
+    if values.size == 0:
+        return np.zeros(0, dtype=np.uint8)
+    if int(values.max()) < 0x80:
+        return values.astype(np.uint8)
+
+    total_bytes = 0
+    for start in range(0, values.size, chunk_size):
+        total_bytes += int(_varint_lengths(values[start:start + chunk_size]).sum(dtype=np.int64))
+    encoded = np.empty(total_bytes, dtype=np.uint8)
+
+    position = 0
+    for start in range(0, values.size, chunk_size):
+        chunk = np.asarray(values[start:start + chunk_size], dtype=np.uint32)
+        lengths = _varint_lengths(chunk)
+        offsets = np.cumsum(lengths, dtype=np.int32)
+        chunk_bytes = int(offsets[-1])
+        offsets -= lengths
+        output = encoded[position:position + chunk_bytes]
+        # 按字节位批量写入：第n个字节取值的第7n位起的7位，后面还有字节时置最高位
+        for byte_index in range(int(lengths.max())):
+            selected = lengths > byte_index
+            byte_values = ((chunk[selected] >> np.uint32(7 * byte_index)) & 0x7F).astype(np.uint8)
+            byte_values[lengths[selected] > byte_index + 1] |= 0x80
+            output[offsets[selected] + byte_index] = byte_values
+        position += chunk_bytes
+    return encoded
+
+
+def validate_palette_ids(block_data, palette_ids, chunk_size=DEFAULT_DECODE_CHUNK):
+    """校验方块数据中的索引都存在于调色板中"""
+    if block_data.size == 0:
+        return
+    known_ids = np.fromiter((int(palette_id) for palette_id in palette_ids), dtype=np.int64)
+    if known_ids.size == 0 or int(block_data.max()) > int(known_ids.max()):
+        raise ValueError(f"发现未映射的方块ID: {int(block_data.max())}")
+    # 分块检查，避免为整个（可能是内存映射的）数组分配布尔掩码
+    for start in range(0, block_data.size, chunk_size):
+        chunk = block_data[start:start + chunk_size]
+        unknown = ~np.isin(chunk, known_ids)
+        if unknown.any():
+            raise ValueError(f"发现未映射的方块ID: {int(chunk[unknown.argmax()])}")
+
+
+def count_block_ids(block_data, size, chunk_size=DEFAULT_DECODE_CHUNK):
+    """分块统计各调色板ID的出现次数，避免一次性把整个数组转换为intp"""
+    counts = np.zeros(size, dtype=np.int64)
+    for start in range(0, block_data.size, chunk_size):
+        counts += np.bincount(block_data[start:start + chunk_size], minlength=size)[:size]
+    return counts
+
+
+def rotate_block_grid(grid):
+    """将(H, L, W)方块网格转换为(新Z, Y, 新X)视图：新Z对应原X，新X对应原Z（方向相反）"""
+    return grid[:, ::-1, :].transpose(2, 0, 1)
+
+
+def layer_rows(layer_chars):
+    """将(Y, X)字符数组转换为每行一个字符串的列表"""
+    height, row_length = layer_chars.shape
+    if row_length == 0:
+        return [""] * height
+    # 连续的U1缓冲区按行重新解释为定长字符串，避免逐字符拼接
+    rows = np.ascontiguousarray(layer_chars).view(f'U{row_length}')
+    return rows.reshape(height).tolist()
+
+
+def java_escape_table(chars):
+    """为非ASCII字符构建str.translate转义表（转为Java的\\uXXXX形式）"""
+    return {ord(char): f"\\u{ord(char):04X}" for char in chars if ord(char) > 0x7F}
+
+
+def java_char_literal(char):
+    """返回可直接写入Java字符字面量的字符"""
+    return char if ord(char) <= 0x7F else f"\\u{ord(char):04X}"
+
+
+def _int_push_cost(value):
+    """返回把整数常量压栈的(字节码长度, 常量池条目数)"""
+    if value <= 5:
+        return 1, 0  # iconst_<n>
+    if value <= 127:
+        return 2, 0  # bipush
+    if value <= 32767:
+        return 3, 0  # sipush
+    return 3, 1  # ldc_w + Integer常量
+
+
+def estimate_layer_cost(row_count, row_bytes):
+    """估算一个LAYER常量在Part类中的(<clinit>字节码长度, 常量池条目数)
+
+    按最坏情况估算：每行都是不同的字符串，且都需要ldc_w加载。
+    """
+    if row_bytes > JAVA_UTF8_CONSTANT_LIMIT:
+        raise ValueError(f"单行字符串编码后为 {row_bytes} 字节，超过Java字符串常量上限 {JAVA_UTF8_CONSTANT_LIMIT}")
+
+    code_bytes, pool_entries = _int_push_cost(row_count)
+    code_bytes += 3 + 3  # anewarray + putstatic
+    pool_entries += 3  # 字段名Utf8 + NameAndType + Fieldref
+    for index in range(row_count):
+        index_code, index_pool = _int_push_cost(index)
+        code_bytes += 1 + index_code + 3 + 1  # dup + 下标 + ldc_w + aastore
+        pool_entries += index_pool + 2  # String + Utf8
+    return code_bytes, pool_entries
+
+
+def layers_per_part(row_count, row_bytes, max_layers=None):
+    """根据<clinit>字节码和常量池上限计算每个Part类能安全容纳的层数"""
+    code_bytes, pool_entries = estimate_layer_cost(row_count, row_bytes)
+    code_budget = int(JAVA_METHOD_CODE_LIMIT * PART_BUDGET_RATIO) - 1  # 末尾的return
+    pool_budget = int(JAVA_CONSTANT_POOL_LIMIT * PART_BUDGET_RATIO) - PART_CLASS_POOL_OVERHEAD
+    if code_bytes > code_budget or pool_entries > pool_budget:
+        raise ValueError(f"单层需要 {code_bytes} 字节码、{pool_entries} 个常量池条目，无法放入一个Java类")
+
+    layer_count = min(code_budget // code_bytes, pool_budget // pool_entries)
+    if max_layers:
+        layer_count = min(layer_count, max_layers)
+    return max(layer_count, 1)
+
+
+def encode_layer_runs(layer_codes):
+    """将一层的字符码点按行优先展平后进行游程编码，返回打包好的(长度, 字符)记录字节"""
+    flat = layer_codes.ravel()
+    if flat.size == 0:
+        return struct.pack(">i", 0)
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    runs = np.empty(starts.size, dtype=LAYER_RESOURCE_RUN_DTYPE)
+    runs['length'] = np.diff(np.append(starts, flat.size))
+    runs['symbol'] = flat[starts]
+    return struct.pack(">i", runs.size) + runs.tobytes()
+
+
+def write_part_file(output_file, package_line, class_name, layers, escape_table=None, collect_chars=True):
+    """流式写出单个Part类文件，返回(写出的层数, 已用字符集合)
+
+    已知各字符出现次数时可关闭collect_chars，省去逐行统计字符的开销（返回空集合）。
+    """
+    layer_count = 0
+    layer_chars = set()
+    with open(output_file, "w", encoding="utf-8", buffering=DEFAULT_WRITE_BUFFER) as writer:
+        writer.write(f"{package_line}\n\npublic class {class_name} {{\n\n")
+
+        # 每个文件内的层号从1开始
+        for layer_count, layer in enumerate(layers, 1):
+            writer.write(f"    public static final String[] LAYER_{layer_count:03} = {{\n")
+            for row in layer:
+                if collect_chars:
+                    layer_chars.update(row)
+                if escape_table:
+                    row = row.translate(escape_table)
+                writer.write(f'        "{row}",\n')
+            writer.write("    };\n\n")
+
+        writer.write("}")
+    return layer_count, layer_chars
+
+
+def _temp_output_path(output_file):
+    """输出文件先写入同目录的临时文件，内容比较后再替换"""
+    return output_file.with_name(output_file.name + ".tmp")
+
+
+def _file_digest(file_path):
+    """计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_grid_layer_codes(grid, lut, layer_indices):
+    """按给定的原X索引顺序逐层生成经lut映射后的(行, 列)数组
+
+    每次连续拷贝一批原X切片，避免逐层跨步访问整个（可能是内存映射的）数组。
+    Part类、层资源、去重哈希和Part签名都经由这里取层，层的行列顺序只在此处定义。
+    """
+    for slab_start in range(0, len(layer_indices), DEFAULT_LAYER_SLAB):
+        slab_indices = layer_indices[slab_start:slab_start + DEFAULT_LAYER_SLAB]
+        if isinstance(slab_indices, range):
+            slab_indices = slice(slab_indices.start, slab_indices.stop, slab_indices.step)
+        slab = np.ascontiguousarray(grid[:, :, slab_indices])
+        yield from np.ascontiguousarray(rotate_block_grid(lut.take(slab)))
+
+
+def iter_grid_layers(grid, char_lut, layer_indices):
+    """按给定的原X索引顺序逐层生成行字符串"""
+    for layer_chars in iter_grid_layer_codes(grid, char_lut, layer_indices):
+        yield layer_rows(layer_chars)
+
+
+def _write_part_worker(task):
+    """进程池任务：从内存映射的方块文件读取指定的层并写出Part文件"""
+    block_file, shape, char_lut, escape_table, layer_indices, output_file, package_line, class_name, collect_chars = task
+    blocks = np.memmap(block_file, dtype=np.uint32, mode='r', shape=shape)
+    layers = iter_grid_layers(blocks, char_lut, layer_indices)
+    return write_part_file(output_file, package_line, class_name, layers, escape_table, collect_chars)
+
+
+# ----------------------
+# 方块状态处理
+# ----------------------
+def strip_state_name(block_name, keep_rules=None):
+    """按规则移除方块状态：keep_rules为{通配符: 保留的状态名列表}，按顺序取第一个匹配的规则，未匹配时全部移除"""
+    base_name, _, states = block_name.partition('[')
+    if not states or not keep_rules:
+        return base_name
+
+    kept_states = []
+    for pattern, state_names in keep_rules.items():
+        if fnmatch.fnmatchcase(base_name, pattern):
+            kept_states = state_names
+            break
+    if not kept_states:
+        return base_name
+
+    pairs = [pair for pair in states.rstrip(']').split(',') if pair.split('=', 1)[0] in kept_states]
+    return f"{base_name}[{','.join(pairs)}]" if pairs else base_name
+
+
+def strip_block_states(palette_items, block_data, keep_rules=None, out=None):
+    """移除方块状态并合并重复的方块ID，返回(紧凑调色板, 重映射后的方块数据, 统计信息)
+
+    新调色板按原索引顺序编号为连续的0..n-1，方块数据通过一次查找表索引完成重映射；
+    out可以是block_data本身，实现原地重映射。统计信息中的counts为新调色板各项的出现次数。
+    """
+    entries = sorted((int(index), name) for name, index in palette_items)
+    lut_size = entries[-1][0] + 1 if entries else 0
+    lut = np.zeros(lut_size, dtype=np.uint32)
+    new_palette = {}
+    duplicate_indices = []
+    stripped_count = 0
+
+    for index, name in entries:
+        base_name = strip_state_name(name, keep_rules)
+        if base_name != name:
+            stripped_count += 1
+        if base_name in new_palette:
+            duplicate_indices.append(index)
+        else:
+            new_palette[base_name] = len(new_palette)
+        lut[index] = new_palette[base_name]
+
+    counts = count_block_ids(block_data, lut_size)
+    remapped = np.empty(block_data.shape, dtype=np.uint32) if out is None else out
+    for start in range(0, block_data.size, DEFAULT_DECODE_CHUNK):
+        remapped[start:start + DEFAULT_DECODE_CHUNK] = lut[block_data[start:start + DEFAULT_DECODE_CHUNK]]
+    stats = {
+        'stripped': stripped_count,
+        'duplicates': len(duplicate_indices),
+        'merged_blocks': int(counts[duplicate_indices].sum()),
+        'palette_size': len(new_palette),
+        'counts': np.bincount(lut, weights=counts, minlength=len(new_palette)).astype(np.int64)
+    }
+    return new_palette, remapped, stats
+
+
+# ----------------------
+# 流式NBT加载
+# ----------------------
+def nbt_payload_size(file_path):
+    """不解压估算NBT数据大小：gzip文件读取尾部的ISIZE字段，未压缩文件直接取文件大小
+
+    ISIZE只记录解压后大小对2^32取模的值；比压缩后大小还小时视为已回绕，按至少4GiB处理。
+    """
+    with open(file_path, "rb") as raw_file:
+        if raw_file.read(2) != b"\x1f\x8b":
+            return os.path.getsize(file_path)
+        raw_file.seek(-4, os.SEEK_END)
+        payload_size = struct.unpack("<I", raw_file.read(4))[0]
+    compressed_size = os.path.getsize(file_path)
+    if payload_size < compressed_size:
+        payload_size += 1 << 32
+    return payload_size
+
+
+class StreamingNbtReader:
+    """边解压边解析的NBT读取器：大数组写入临时内存映射文件，不构建逐元素的Python对象"""
+
+    ARRAY_DTYPES = {7: np.dtype(np.int8), 11: np.dtype(">i4"), 12: np.dtype(">i8")}
+    SCALAR_FORMATS = {1: ">b", 2: ">h", 3: ">i", 4: ">q", 5: ">f", 6: ">d"}
+
+    def __init__(self, stream, spill_dir, spill_threshold=DEFAULT_SPILL_THRESHOLD,
+                 skip_keys=DEFAULT_STREAM_SKIP_KEYS):
+        self.stream = stream
+        self.spill_dir = Path(spill_dir)
+        self.spill_threshold = spill_threshold
+        self.skip_keys = skip_keys
+        self.spill_count = 0
+
+    @classmethod
+    def load(cls, file_path, spill_dir, **kwargs):
+        """读取（可能经gzip压缩的）NBT文件，返回根复合标签的字典"""
+        with open(file_path, "rb") as raw_file:
+            compressed = raw_file.read(2) == b"\x1f\x8b"
+            raw_file.seek(0)
+            stream = gzip.GzipFile(fileobj=raw_file) if compressed else raw_file
+            with stream:
+                return cls(stream, spill_dir, **kwargs).read_root()
+
+    def read_root(self):
+        tag_type = self._read_struct(">b")
+        if tag_type != 10:
+            raise ValueError(f"NBT根标签不是复合标签: {tag_type}")
+        self._read_string()
+        return self._read_payload(10, keep=True)
+
+    def _read_exact(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise ValueError("NBT数据意外结束")
+        return data
+
+    def _read_struct(self, fmt):
+        return struct.unpack(fmt, self._read_exact(struct.calcsize(fmt)))[0]
+
+    def _read_string(self):
+        data = self._read_exact(self._read_struct(">H"))
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError:
+            return data.decode("utf-8", errors="replace")
+
+    def _read_payload(self, tag_type, keep):
+        if tag_type in self.SCALAR_FORMATS:
+            return self._read_struct(self.SCALAR_FORMATS[tag_type])
+        if tag_type == 8:
+            return self._read_string()
+        if tag_type in self.ARRAY_DTYPES:
+            return self._read_array(self.ARRAY_DTYPES[tag_type], self._read_struct(">i"), keep)
+        if tag_type == 9:
+            item_type = self._read_struct(">b")
+            items = [self._read_payload(item_type, keep) for _ in range(self._read_struct(">i"))]
+            return items if keep else None
+        if tag_type == 10:
+            compound = {}
+            while True:
+                child_type = self._read_struct(">b")
+                if child_type == 0:
+                    return compound if keep else None
+                name = self._read_string()
+                child_keep = keep and name not in self.skip_keys
+                value = self._read_payload(child_type, child_keep)
+                if child_keep:
+                    compound[name] = value
+        raise ValueError(f"未知的NBT标签类型: {tag_type}")
+
+    def _read_array(self, dtype, length, keep):
+        """读取数组负载：小数组直接读入内存，大数组分块写入内存映射文件"""
+        nbytes = length * dtype.itemsize
+        if not keep:
+            for _ in self._iter_chunks(nbytes):
+                pass
+            return None
+        if nbytes < self.spill_threshold:
+            return np.frombuffer(self._read_exact(nbytes), dtype=dtype)
+
+        self.spill_count += 1
+        spill_file = self.spill_dir / f"array{self.spill_count}.bin"
+        with open(spill_file, "wb") as writer:
+            for chunk in self._iter_chunks(nbytes):
+                writer.write(chunk)
+        return np.memmap(spill_file, dtype=dtype, mode="r", shape=(length,))
+
+    def _iter_chunks(self, nbytes, chunk_size=DEFAULT_DECODE_CHUNK):
+        remaining = nbytes
+        while remaining:
+            chunk = self._read_exact(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            yield chunk
+
+
+# ----------------------
+# 结构文件读取
+# ----------------------
+class SchematicData:
+    """各格式统一解码后的结构：调色板(方块名 -> 索引) + 按 y*W*L + z*W + x 排列的索引数组"""
+
+    def __init__(self, format_name, width, height, length, palette, block_data):
+        self.format_name = format_name
+        self.width = int(width)
+        self.height = int(height)
+        self.length = int(length)
+        self.palette = palette
+        self.block_data = block_data  # Sponge的原始BlockData标签，或已解码的uint32数组
+
+
+def block_state_name(state_tag):
+    """将{Name, Properties}形式的方块状态转换为Sponge调色板中的字符串形式"""
+    name = str(state_tag['Name'])
+    properties = state_tag.get('Properties') or {}
+    if not properties:
+        return name
+    return f"{name}[{','.join(f'{key}={properties[key]}' for key in sorted(properties))}]"
+
+
+def unpack_bit_array(longs, bits, count, chunk_size=DEFAULT_DECODE_CHUNK):
+    """解包Litematica的紧密位数组（条目可跨越long边界），返回uint32数组"""
+    words = np.asarray(longs).view(">u8").astype(np.uint64)
+    mask = np.uint64((1 << bits) - 1)
+    values = np.empty(count, dtype=np.uint32)
+    for start in range(0, count, chunk_size):
+        bit_index = np.arange(start, min(start + chunk_size, count), dtype=np.uint64) * np.uint64(bits)
+        word_index = (bit_index >> np.uint64(6)).astype(np.intp)
+        bit_offset = bit_index & np.uint64(63)
+        chunk = words[word_index] >> bit_offset
+
+        # 跨越long边界的条目再拼接下一个long的低位
+        spans = bit_offset + np.uint64(bits) > np.uint64(64)
+        if spans.any():
+            chunk[spans] |= words[word_index[spans] + 1] << (np.uint64(64) - bit_offset[spans])
+        values[start:start + chunk.size] = chunk & mask
+    return values
+
+
+def _merge_palette(state_names, palette):
+    """把局部调色板并入全局调色板，返回局部索引到全局索引的查找表"""
+    lut = np.empty(len(state_names), dtype=np.uint32)
+    for local_index, name in enumerate(state_names):
+        lut[local_index] = palette.setdefault(name, len(palette))
+    return lut
+
+
+def _unsigned_short(value):
+    """Sponge格式的尺寸是无符号short，超过32767时NBT中读出的是负数"""
+    return int(value) & 0xFFFF
+
+
+def read_sponge_v2(root):
+    return SchematicData("Sponge v2", _unsigned_short(root['Width']), _unsigned_short(root['Height']),
+                         _unsigned_short(root['Length']), root['Palette'], root['BlockData'])
+
+
+def read_sponge_v3(root):
+    schematic = root['Schematic']
+    blocks = schematic['Blocks']
+    return SchematicData("Sponge v3", _unsigned_short(schematic['Width']), _unsigned_short(schematic['Height']),
+                         _unsigned_short(schematic['Length']), blocks['Palette'], blocks['Data'])
+
+
+def read_litematica(root):
+    """读取.litematic：多个区域合并到共同的包围盒中，空缺位置填充空气"""
+    regions = []
+    for region in root['Regions'].values():
+        position = [int(region['Position'][axis]) for axis in "xyz"]
+        size = [int(region['Size'][axis]) for axis in "xyz"]
+        # 尺寸为负表示区域向负方向延伸，方块按最小角点存储
+        origin = [pos + size_axis + 1 if size_axis < 0 else pos for pos, size_axis in zip(position, size)]
+        regions.append((origin, [abs(size_axis) for size_axis in size], region))
+
+    min_corner = [min(origin[axis] for origin, _, _ in regions) for axis in range(3)]
+    max_corner = [max(origin[axis] + size[axis] for origin, size, _ in regions) for axis in range(3)]
+    width, height, length = (max_corner[axis] - min_corner[axis] for axis in range(3))
+
+    palette = {"minecraft:air": 0}
+    grid = np.zeros((height, length, width), dtype=np.uint32)
+    for origin, (size_x, size_y, size_z), region in regions:
+        state_names = [block_state_name(state) for state in region['BlockStatePalette']]
+        bits = max(2, (len(state_names) - 1).bit_length())
+        local_ids = unpack_bit_array(region['BlockStates'], bits, size_x * size_y * size_z)
+        region_ids = _merge_palette(state_names, palette)[local_ids].reshape(size_y, size_z, size_x)
+
+        x0, y0, z0 = (origin[axis] - min_corner[axis] for axis in range(3))
+        target = grid[y0:y0 + size_y, z0:z0 + size_z, x0:x0 + size_x]
+        # 区域重叠时只覆盖非空气方块
+        np.copyto(target, region_ids, where=region_ids != palette["minecraft:air"])
+    return SchematicData("Litematica", width, height, length, palette, grid.reshape(-1))
+
+
+def read_structure_nbt(root):
+    """读取原版结构方块导出的.nbt：未记录的位置（结构空位）视为空气"""
+    width, height, length = (int(value) for value in root['size'])
+    states = root['palette'] if 'palette' in root else root['palettes'][0]
+    palette = {}
+    lut = _merge_palette([block_state_name(state) for state in states], palette)
+    air_id = palette.setdefault("minecraft:air", len(palette))
+
+    grid = np.full((height, length, width), air_id, dtype=np.uint32)
+    blocks = root['blocks']
+    if blocks:
+        positions = np.array([[int(value) for value in block['pos']] for block in blocks], dtype=np.intp)
+        state_ids = np.fromiter((int(block['state']) for block in blocks), dtype=np.intp, count=len(blocks))
+        grid[positions[:, 1], positions[:, 2], positions[:, 0]] = lut[state_ids]
+    return SchematicData("结构方块NBT", width, height, length, palette, grid.reshape(-1))
+
+
+# 格式识别与读取函数，按顺序取第一个识别成功的读取器；可追加自定义格式
+SCHEMATIC_READERS = [
+    ("Sponge v3", lambda root: 'Schematic' in root and 'Blocks' in root['Schematic'], read_sponge_v3),
+    ("Sponge v2", lambda root: 'Palette' in root and 'BlockData' in root, read_sponge_v2),
+    ("Litematica", lambda root: 'Regions' in root, read_litematica),
+    ("结构方块NBT", lambda root: 'size' in root and 'blocks' in root, read_structure_nbt),
+]
+
+
+def read_schematic(root):
+    """自动识别NBT根标签对应的结构格式并解码"""
+    for _, detect, reader in SCHEMATIC_READERS:
+        if detect(root):
+            return reader(root)
+    raise ValueError("无法识别的结构文件格式")
+
+
+# ----------------------
+# 调色板分类
+# ----------------------
+class AhoCorasick:
+    """多关键词子串匹配自动机，一次扫描找出文本中出现的全部关键词"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for symbol in pattern:
+                next_state = self.goto[state].get(symbol)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][symbol] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append(pattern_id)
+
+        # 广度优先构建失败指针，并把失败状态的输出合并进来
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for symbol, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and symbol not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(symbol, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find_all(self, text):
+        """返回text中出现过的关键词编号集合"""
+        found = set()
+        state = 0
+        for symbol in text:
+            while state and symbol not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(symbol, 0)
+            if self.outputs[state]:
+                found.update(self.outputs[state])
+        return found
+
+
+class PaletteClassifier:
+    """预编译的调色板分类器：特殊字符按小写精确匹配，复杂条件按子串匹配，保持配置中的优先级"""
+
+    def __init__(self, special_chars, complex_conditions):
+        # 特殊字符：小写关键词 -> 字符，先出现的字符优先
+        self.special_map = {}
+        for char, config in special_chars.items():
+            for keyword in config.get('keywords', []):
+                self.special_map.setdefault(keyword.lower(), char)
+
+        # 复杂条件：每个不同的小写关键词只保留优先级最高的(字符顺序, 关键词顺序)
+        self.complex_rules = {}
+        for char_rank, (char, config) in enumerate(complex_conditions.items()):
+            for keyword_rank, keyword in enumerate(config.get('keywords', [])):
+                rule = (char_rank, keyword_rank, char, keyword)
+                current = self.complex_rules.get(keyword.lower())
+                if current is None or rule < current:
+                    self.complex_rules[keyword.lower()] = rule
+        self.complex_patterns = list(self.complex_rules)
+        self.automaton = AhoCorasick(self.complex_patterns)
+        # 空关键词匹配任意方块名，自动机无法表示，单独处理
+        self.empty_rule = self.complex_rules.get("")
+        self.cache = {}  # 方块名 -> 分类结果，分类器在多次转换间复用时避免重复匹配
+
+    def classify(self, block_name):
+        """返回(类别, 字符, 关键词)；未命中任何配置时返回None"""
+        result = self.cache.get(block_name, self)
+        if result is self:
+            result = self.cache[block_name] = self._classify(block_name)
+        return result
+
+    def _classify(self, block_name):
+        if block_name == "minecraft:air" or block_name == "air":
+            return "air", " ", None
+
+        lower_name = block_name.lower()
+        special_char = self.special_map.get(lower_name)
+        if special_char is not None:
+            return "special", special_char, None
+
+        rules = [self.complex_rules[self.complex_patterns[i]] for i in self.automaton.find_all(lower_name)]
+        if self.empty_rule is not None:
+            rules.append(self.empty_rule)
+        if rules:
+            _, _, char, keyword = min(rules)
+            return "complex", char, keyword
+        return None
+
+
+# ----------------------
+# 输出目标
+# ----------------------
+class DirectorySink:
+    """把生成的文件写入输出目录：先写临时文件，内容与清单一致时保留原文件"""
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.output_files = []  # 本次转换写出的全部文件
+        self.manifest = None  # 输出文件内容哈希清单，首次写出时加载
+
+    def temp_path(self, output_file):
+        """返回写出output_file时使用的临时文件路径（首次写出时才创建输出目录）"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        return _temp_output_path(output_file)
+
+    def write_text(self, output_file, text):
+        """写出文本文件（内容未变化时不改动原文件），返回是否实际写入"""
+        self.temp_path(output_file).write_text(text, encoding="utf-8")
+        return self.commit(output_file)
+
+    def commit(self, output_file):
+        """比较临时文件与清单中的内容哈希，仅在内容变化时替换目标文件"""
+        manifest = self._load_manifest()
+        temp_file = _temp_output_path(output_file)
+        digest = _file_digest(temp_file)
+        record = manifest.get(output_file.name)
+        self.output_files.append(output_file)
+
+        if record is not None and record['sha256'] == digest and output_file.is_file():
+            stat = output_file.stat()
+            # 文件大小和修改时间与清单一致时直接信任清单中的哈希
+            if (stat.st_size, stat.st_mtime_ns) == (record['size'], record['mtime_ns']) \
+                    or _file_digest(output_file) == digest:
+                temp_file.unlink()
+                manifest[output_file.name] = {'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                return False
+
+        os.replace(temp_file, output_file)
+        stat = output_file.stat()
+        manifest[output_file.name] = {'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return True
+
+    def reuse(self, output_file):
+        """输出文件与清单记录一致时直接沿用，返回是否可以沿用"""
+        record = self._load_manifest().get(output_file.name)
+        if record is None or not output_file.is_file():
+            return False
+        stat = output_file.stat()
+        if (stat.st_size, stat.st_mtime_ns) != (record['size'], record['mtime_ns']):
+            return False
+        self.output_files.append(output_file)
+        return True
+
+    def size(self, output_file):
+        return output_file.stat().st_size if output_file.is_file() else 0
+
+    def _load_manifest(self):
+        """读取输出目录中的内容哈希清单"""
+        if self.manifest is None:
+            manifest_file = self.output_dir / PARTS_MANIFEST_NAME
+            try:
+                self.manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.manifest = {}
+        return self.manifest
+
+    def save_manifest(self):
+        if not self.output_dir.is_dir():
+            return
+        manifest_file = self.output_dir / PARTS_MANIFEST_NAME
+        manifest_file.write_text(json.dumps(self._load_manifest(), indent=2, sort_keys=True), encoding="utf-8")
+
+    def remove_stale(self, class_prefix):
+        """删除旧版本结构（或另一种输出模式）遗留的多余Part文件和层资源文件"""
+        if not self.output_dir.is_dir():
+            return
+        manifest = self._load_manifest()
+        current_names = {output_file.name for output_file in self.output_files}
+        part_pattern = re.compile(rf"{re.escape(class_prefix)}_(Part\d+\.java|Layers\.java|layers\.bin)")
+        for part_file in self.output_dir.glob(f"{class_prefix}_*"):
+            if part_pattern.fullmatch(part_file.name) and part_file.name not in current_names:
+                part_file.unlink()
+                manifest.pop(part_file.name, None)
+                print(f"删除多余的结构类文件: {part_file}")
+
+
+def output_sink(config):
+    """创建写入config['output_dir']（缺省为multiblock/<结构名>）的DirectorySink"""
+    return DirectorySink(config.get('output_dir') or Path(DEFAULT_OUTPUT_ROOT) / structure_name(config))
+
+
+class MemorySink:
+    """把生成的文件保存在内存中：files为 文件名 -> 文本（.bin资源为bytes）
+
+    Part文件仍先流式写入私有临时目录（进程池工作进程也可写入），提交时读回内存。
+    """
+
+    def __init__(self):
+        self.output_dir = Path("<memory>")  # 仅用于进度输出中的显示名
+        self.files = {}
+        self.output_files = []
+        self.temp_dir = None
+
+    def temp_path(self, output_file):
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="schem_out_", ignore_cleanup_errors=True)
+        return Path(self.temp_dir.name) / _temp_output_path(Path(output_file.name)).name
+
+    def write_text(self, output_file, text):
+        self.files[output_file.name] = text
+        self.output_files.append(output_file)
+        return True
+
+    def commit(self, output_file):
+        temp_file = self.temp_path(output_file)
+        data = temp_file.read_bytes()
+        temp_file.unlink()
+        self.files[output_file.name] = data if output_file.suffix == ".bin" else data.decode("utf-8")
+        self.output_files.append(output_file)
+        return True
+
+    def reuse(self, output_file):
+        return False
+
+    def size(self, output_file):
+        content = self.files.get(output_file.name, b"")
+        return len(content.encode("utf-8") if isinstance(content, str) else content)
+
+    def save_manifest(self):
+        pass
+
+    def remove_stale(self, class_prefix):
+        pass
+
+
+# ----------------------
+# 性能剖析
+# ----------------------
+class StageProfiler:
+    """记录转换器各阶段的墙钟时间、CPU时间、峰值内存以及方块数和字节数"""
+
+    def __init__(self, trace_memory=True, cprofile=False):
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.records = []
+        self.depth = 0
+        self.peak_stack = []
+        self.profiles = []  # 顶层阶段的(记录, cProfile.Profile)
+        self.started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """测量一个阶段，返回的记录字典可由调用方补充方块数和字节数"""
+        record = {'stage': name, 'depth': self.depth}
+        self.records.append(record)
+        profile = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            # 嵌套阶段会重置峰值，先把外层阶段到目前为止的峰值保存下来
+            if self.peak_stack:
+                self.peak_stack[-1] = max(self.peak_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self.peak_stack.append(0)
+        # cProfile不能嵌套启用，只剖析顶层阶段
+        if self.cprofile and self.depth == 0:
+            profile = cProfile.Profile()
+            self.profiles.append((record, profile))
+
+        self.depth += 1
+        start_times = os.times()
+        start_cpu = time.process_time()
+        start_wall = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        except BaseException as err:
+            record['error'] = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+            end_times = os.times()
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            # 进程池工作进程的CPU时间在其退出后计入子进程时间
+            record['child_cpu_seconds'] = (end_times.children_user - start_times.children_user
+                                           + end_times.children_system - start_times.children_system)
+            self.depth -= 1
+            if self.trace_memory:
+                peak = max(self.peak_stack.pop(), tracemalloc.get_traced_memory()[1])
+                record['peak_bytes'] = peak
+                if self.peak_stack:
+                    self.peak_stack[-1] = max(self.peak_stack[-1], peak)
+                if self.depth == 0 and self.started_tracing:
+                    tracemalloc.stop()
+                    self.started_tracing = False
+
+    def slowest_profile(self):
+        """返回耗时最长的顶层阶段的(记录, cProfile.Profile)"""
+        if not self.profiles:
+            return None
+        return max(self.profiles, key=lambda item: item[0]['wall_seconds'])
+
+    def print_report(self):
+        """打印各阶段的耗时、内存和吞吐量汇总表"""
+        print(f"{'阶段':<40}{'墙钟(秒)':>10}{'CPU(秒)':>10}{'峰值内存(MB)':>14}{'方块/秒':>12}{'读取(KB)':>11}{'写出(KB)':>11}")
+        for record in self.records:
+            name = "  " * record['depth'] + record['stage']
+            peak = f"{record['peak_bytes'] / (1 << 20):.1f}" if 'peak_bytes' in record else "-"
+            rate = "-"
+            if record.get('blocks') and record['wall_seconds'] > 0:
+                rate = f"{record['blocks'] / record['wall_seconds']:.3g}"
+            read_kb = f"{record['bytes_read'] / 1024:.1f}" if record.get('bytes_read') else "-"
+            written_kb = f"{record['bytes_written'] / 1024:.1f}" if record.get('bytes_written') else "-"
+            cpu_seconds = record['cpu_seconds'] + record['child_cpu_seconds']
+            print(f"{name:<40}{record['wall_seconds']:>10.4f}{cpu_seconds:>10.4f}{peak:>14}{rate:>12}"
+                  f"{read_kb:>11}{written_kb:>11}")
+
+    def save(self, trace_file, extra=None):
+        """写出JSON格式的剖析记录；启用cProfile时同时转储最慢阶段的统计数据"""
+        trace_file = Path(trace_file)
+        trace_file.parent.mkdir(parents=True, exist_ok=True)
+        trace = {'tool_version': TOOL_VERSION, **(extra or {}), 'stages': self.records}
+
+        slowest = self.slowest_profile()
+        if slowest is not None:
+            record, profile = slowest
+            profile_file = trace_file.with_name(f"{trace_file.stem}.{record['stage']}.prof")
+            profile.dump_stats(profile_file)
+            trace['cprofile'] = {'stage': record['stage'], 'file': str(profile_file)}
+            print(f"最慢阶段 {record['stage']} 的cProfile数据: {profile_file}（可用 python -m pstats 查看）")
+
+        trace_file.write_text(json.dumps(trace, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"剖析记录已保存: {trace_file}")
+        return trace_file
+
+
+def profiled_stage(method):
+    """转换器方法的剖析钩子：未设置profiler时直接调用，不产生额外开销"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        if profiler is None:
+            return method(self, *args, **kwargs)
+
+        written_before = len(self.output_files)
+        with profiler.stage(method.__name__) as record:
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                # 以输入文件路径为参数的阶段记录读取字节数，其余记录新写出的文件大小
+                if args and isinstance(args[0], (str, os.PathLike)) and os.path.isfile(args[0]):
+                    record['bytes_read'] = os.path.getsize(args[0])
+                record['bytes_written'] = sum(
+                    self.sink.size(output_file) for output_file in self.output_files[written_before:]
+                )
+                if self.width and self.length and self.height:
+                    record['blocks'] = self.width * self.length * self.height
+    return wrapper
+
+
 # ----------------------
 # 核心逻辑
 # ----------------------
 class SchematicConverter:
-    def __init__(self, config):
+    def __init__(self, config, sink=None, classifier=None):
+        """构造时不读写任何文件；sink为输出目标，默认写入config['output_dir']或multiblock/<结构名>
+
+        classifier可传入已构建的PaletteClassifier，在多次转换间共享分类结果。
+        """
         self.config = config
-        self.output_dir = Path(DEFAULT_OUTPUT_ROOT) / Path(config['INPUT_FILE']).stem
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if sink is None:
+            sink = output_sink(config)
+        self.sink = sink
+        self.output_dir = sink.output_dir
         self.palette = {}
-        self.block_data = []
+        self.block_data = np.zeros(0, dtype=np.uint32)
+        self.block_counts = None  # 各调色板ID在结构中的出现次数
+        self.spill_dir = None  # 流式加载的内存映射临时目录
+        self.trim_offset = (0, 0, 0)  # 裁剪后原点在原结构中的坐标(x, y, z)
         self.width = 0
         self.length = 0
         self.height = 0
         self.auto_char_map = {}
         self.used_chars = set(config['SPECIAL_CHARS'].keys()) | set(config['complex_conditions'].keys())
         self.char_generator = self.create_char_generator()
+        self.classifier = classifier or PaletteClassifier(config['SPECIAL_CHARS'], config['complex_conditions'])
+        self.quiet = config.get('quiet', False)  # 静默模式：不逐条打印调色板映射
         self.layers = []  # 显式初始化实例变量
+        self.aisle_refs = []  # 按结构顺序排列的每个aisle引用的层常量
+        self.part_layer_refs = []  # 写出Part文件时同步收集的层常量引用
+        self.layer_chars = set()  # 结构中实际出现的字符
+        self.char_index = {}  # 字符 -> [(方块名, 调色板ID)]，解析调色板时按分配顺序建立
+        self.palette_names = {}  # 调色板ID -> 方块名（移除方块状态之后）
+        self.profiler = None  # 设置为StageProfiler后记录各阶段的耗时和内存
+        self.part_cache = None  # Part文件名 -> (源签名, 层数, 已用字符)，设置后源层未变化的Part跳过生成
 
     def create_char_generator(self):
         """字符生成序列：按类别优先级分配字符"""
-        # 按优先级顺序遍历所有字符类别
-        for category in CHAR_CATEGORIES:
+        # 按优先级顺序遍历所有字符类别，单符号用尽后使用扩展字符
+        for category in CHAR_CATEGORIES + OVERFLOW_CHAR_CATEGORIES:
             for symbol in category:
                 if symbol not in self.used_chars:
                     yield symbol
@@ -144,28 +1314,198 @@ class SchematicConverter:
         # 如果所有字符都不够用，抛出错误
         raise ValueError("字符资源耗尽，请减少唯一方块种类")
 
+    @profiled_stage
     def load_schematic(self, file_path):
-        """加载并解析.schem文件"""
+        """加载并解析结构文件（自动识别Sponge v2/v3、Litematica和原版结构NBT）"""
         try:
-            # 使用nbtlib加载.schem文件
-            nbt_data = nbtlib.load(file_path)
-
-            # 获取结构尺寸
-            self.width = nbt_data['Width']
-            self.length = nbt_data['Length']
-            self.height = nbt_data['Height']
+            region = self.config.get('region')
+            block_source = self.config.get('block_source')
+            if block_source is not None:
+                # 分块转换：主进程已把方块数据解码到共享文件，这里只映射文件而不读取结构
+                nbt_data = None
+                format_name = "分块源数据"
+                self.width, self.height, self.length = block_source['size']
+                palette_tag = block_source['palette']
+            else:
+                nbt_data = self._read_nbt(file_path)
+                schematic = read_schematic(nbt_data)
+                format_name = schematic.format_name
+                self.width, self.height, self.length = schematic.width, schematic.height, schematic.length
+                palette_tag = schematic.palette
 
+            print(f"结构格式: {format_name}")
             print(f"结构尺寸: {self.width}x{self.length}x{self.height}")
 
+            # 先解析方块数据并统计各方块出现次数，字符分配依赖频率
+            if block_source is not None:
+                # 写时复制映射：区域覆盖整行时切片不会复制，后续原地重映射也不会改动共享文件
+                self.block_data = np.memmap(block_source['file'], dtype=np.uint32, mode="c",
+                                            shape=(self.width * self.height * self.length,))
+                self.crop_to_region(region or (0, 0, 0, self.width, self.height, self.length),
+                                    max((int(palette_id) for palette_id in palette_tag.values()), default=-1) + 1)
+            else:
+                self.decode_nbt_block_data(schematic.block_data, palette_tag.values())
+                if region is not None:
+                    self.crop_to_region(region)
+
+            # 可选：在内存中移除方块状态并合并调色板，无需先生成*_clean.schem
+            if self.config.get('state_rules') is not None:
+                palette_tag = self.strip_block_states(palette_tag)
+                if self.config.get('clean_output'):
+                    # 只有未截取区域的Sponge v2可以原样保留其他标签，其余情况输出最小的Sponge v2文件
+                    source_data = nbt_data if format_name == "Sponge v2" and region is None else None
+                    self.write_clean_schematic(source_data, palette_tag, self.config['clean_output'])
+
             # 解析调色板
-            self.parse_nbt_palette(nbt_data['Palette'])
+            self.parse_nbt_palette(palette_tag)
 
-            # 解析方块数据
-            self.decode_nbt_block_data(nbt_data['BlockData'])
+            # 可选：裁剪到非空气方块的包围盒
+            if self.config.get('trim'):
+                self.trim_to_bounding_box()
 
         except Exception as err:
-            raise ValueError(f"解析.schem文件失败: {str(err)}")
-
+            raise ValueError(f"解析结构文件失败: {str(err)}")
+
+    @profiled_stage
+    def crop_to_region(self, region, palette_size=None):
+        """只保留region=(x0, y0, z0, x1, y1, z1)半开区间内的方块，返回区域原点(x, y, z)
+
+        切片在原方块缓冲区上按步长取值；缓冲区是内存映射文件时只读入区域所在的页，
+        复制出的数组大小与区域成正比。
+        """
+        x0, y0, z0, x1, y1, z1 = (int(value) for value in region)
+        if not (0 <= x0 < x1 <= self.width and 0 <= y0 < y1 <= self.height and 0 <= z0 < z1 <= self.length):
+            raise ValueError(f"区域 ({x0}, {y0}, {z0})-({x1}, {y1}, {z1}) 超出结构范围 "
+                             f"{self.width}x{self.height}x{self.length}（X×Y×Z）或为空")
+        if palette_size is None:
+            palette_size = self.block_counts.size
+
+        old_size = (self.width, self.height, self.length)
+        grid = self.block_data.reshape(self.height, self.length, self.width)
+        self.block_data = np.ascontiguousarray(grid[y0:y1, z0:z1, x0:x1]).reshape(-1)
+        self.width, self.height, self.length = x1 - x0, y1 - y0, z1 - z0
+        self.block_counts = count_block_ids(self.block_data, palette_size)
+        self.trim_offset = (x0, y0, z0)
+
+        if (self.width, self.height, self.length) != old_size:
+            print(f"转换区域: ({x0}, {y0}, {z0})-({x1}, {y1}, {z1})，尺寸 "
+                  f"{self.width}x{self.length}x{self.height}")
+        return self.trim_offset
+
+    @profiled_stage
+    def trim_to_bounding_box(self):
+        """裁剪掉结构四周全是空气的切片，返回裁剪偏移(x, y, z)"""
+        air_ids = [int(palette_id) for palette_id, char in self.palette.items() if char == ' ']
+        grid = np.asarray(self.block_data).reshape(self.height, self.length, self.width)
+
+        # 按Y分块统计各轴上是否存在非空气方块，只保留三个一维掩码
+        y_any = np.zeros(self.height, dtype=bool)
+        z_any = np.zeros(self.length, dtype=bool)
+        x_any = np.zeros(self.width, dtype=bool)
+        slab_height = max(1, DEFAULT_DECODE_CHUNK // max(1, self.length * self.width))
+        for y_start in range(0, self.height, slab_height):
+            solid = ~np.isin(grid[y_start:y_start + slab_height], air_ids)
+            y_any[y_start:y_start + slab_height] = solid.any(axis=(1, 2))
+            z_any |= solid.any(axis=(0, 2))
+            x_any |= solid.any(axis=(0, 1))
+
+        if not y_any.any():
+            print("结构中没有非空气方块，跳过裁剪")
+            return 0, 0, 0
+
+        controllers_before = self._special_block_positions()
+        (x0, x1), (y0, y1), (z0, z1) = (
+            (int(mask.argmax()), int(mask.size - mask[::-1].argmax())) for mask in (x_any, y_any, z_any)
+        )
+        removed = {
+            'X-': x0, 'X+': self.width - x1, 'Y-': y0, 'Y+': self.height - y1, 'Z-': z0, 'Z+': self.length - z1
+        }
+        if not any(removed.values()):
+            print("结构四周没有多余的空气切片")
+            return 0, 0, 0
+
+        old_size = (self.width, self.height, self.length)
+        self.block_data = np.ascontiguousarray(grid[y0:y1, z0:z1, x0:x1]).reshape(-1)
+        self.width, self.height, self.length = x1 - x0, y1 - y0, z1 - z0
+        self.block_counts = count_block_ids(self.block_data, self.block_counts.size)
+        # 已截取区域时偏移量相对于区域原点，累加后仍是原结构中的坐标
+        self.trim_offset = tuple(base + delta for base, delta in zip(self.trim_offset, (x0, y0, z0)))
+
+        print(f"裁剪空气切片: {old_size[0]}x{old_size[2]}x{old_size[1]} -> "
+              f"{self.width}x{self.length}x{self.height}，移除 " +
+              ", ".join(f"{side}:{count}" for side, count in removed.items() if count))
+        # 控制器等特殊方块都是非空气方块，裁剪后只是坐标整体平移
+        for (char, before), (_, after) in zip(controllers_before, self._special_block_positions()):
+            print(f"特殊方块 '{char}' 位置: {before} -> {after}")
+        return self.trim_offset
+
+    def _special_block_positions(self):
+        """返回SPECIAL_CHARS方块（如控制器）首次出现的(x, y, z)坐标"""
+        positions = []
+        for char in self.config['SPECIAL_CHARS']:
+            special_ids = [int(palette_id) for palette_id, mapped in self.palette.items() if mapped == char]
+            if not special_ids:
+                continue
+            for start in range(0, self.block_data.size, DEFAULT_DECODE_CHUNK):
+                found = np.isin(self.block_data[start:start + DEFAULT_DECODE_CHUNK], special_ids)
+                if found.any():
+                    y, z, x = np.unravel_index(start + int(found.argmax()), (self.height, self.length, self.width))
+                    positions.append((char, (int(x), int(y), int(z))))
+                    break
+        return positions
+
+    @profiled_stage
+    def strip_block_states(self, palette_tag):
+        """按config['state_rules']移除方块状态并原地重映射方块数据，返回新的调色板"""
+        new_palette, self.block_data, stats = strip_block_states(
+            palette_tag.items(), self.block_data, self.config['state_rules'], out=self.block_data
+        )
+        self.block_counts = stats['counts']
+        print(f"移除了 {stats['stripped']} 个方块的状态数据，合并 {stats['duplicates']} 个重复方块ID，"
+              f"调色板压缩为 {stats['palette_size']} 项")
+        return new_palette
+
+    @profiled_stage
+    def write_clean_schematic(self, nbt_data, palette, output_path):
+        """输出移除方块状态后的.schem文件（可选的副产物）"""
+        import nbtlib
+
+        clean_data = nbt_data if isinstance(nbt_data, nbtlib.File) else nbtlib.File(
+            {'Version': nbtlib.Int(2), 'Width': nbtlib.Short(self.width), 'Height': nbtlib.Short(self.height),
+             'Length': nbtlib.Short(self.length)},
+            gzipped=True, root_name="Schematic"
+        )
+        clean_data['Palette'] = nbtlib.Compound({name: nbtlib.Int(index) for name, index in palette.items()})
+        clean_data['PaletteMax'] = nbtlib.Int(len(palette))
+        # 分块编码：临时数组只与分块大小有关，副产物不会比转换本身占用更多内存
+        encoded = encode_varint_array(self.block_data, chunk_size=DEFAULT_DECODE_CHUNK)
+        clean_data['BlockData'] = nbtlib.ByteArray(encoded.view(np.int8))
+        clean_data.save(output_path)
+        print(f"输出移除方块状态后的结构文件: {output_path}")
+
+    @profiled_stage
+    def _read_nbt(self, file_path):
+        """按配置选择nbtlib或流式内存映射方式读取NBT"""
+        loader = self.config.get('loader', 'auto')
+        if loader == 'auto':
+            # 方块数据压缩率常达50~100倍，按解压后大小判断才能避开nbtlib整体加载
+            loader = 'stream' if nbt_payload_size(file_path) >= DEFAULT_STREAM_THRESHOLD else 'nbtlib'
+        if loader == 'nbtlib':
+            # 使用nbtlib加载.schem文件（只在真正读取文件时导入）
+            import nbtlib
+
+            return nbtlib.load(file_path)
+
+        print("使用流式加载，大数组映射到临时文件")
+        return StreamingNbtReader.load(file_path, self._get_spill_dir())
+
+    def _get_spill_dir(self):
+        """流式加载使用的临时目录，随转换器释放"""
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(prefix="schem_", ignore_cleanup_errors=True)
+        return Path(self.spill_dir.name)
+
+    @profiled_stage
     def parse_nbt_palette(self, palette_tag):
         """解析NBT调色板数据"""
         # NBT调色板是字典，键是方块ID，值是调色板索引
@@ -173,50 +1513,53 @@ class SchematicConverter:
 
         for block_name, palette_id in palette_tag.items():
             entries.append((block_name, palette_id))
+            self.palette_names[int(palette_id)] = block_name
 
         # 按调色板索引排序
         entries.sort(key=lambda x: x[1])
 
-        # 处理特殊方块
+        # 处理特殊方块，需要自动分配字符的方块留到最后按频率统一分配
+        auto_entries = []
         for block_name, palette_id in entries:
+            match = self.classifier.classify(block_name)
+
             # 空气方块处理
-            if block_name == "minecraft:air" or block_name == "air":
-                self._handle_air_block(palette_id)
+            if match is not None and match[0] == "air":
+                self._handle_air_block(palette_id, block_name)
                 continue
 
             # 特殊字符匹配（基于配置的关键词）
-            matched_special = False
-            for char, config in self.config['SPECIAL_CHARS'].items():
-                keywords = config.get('keywords', [])
-                for keyword in keywords:
-                    if block_name.lower() == keyword.lower():
-                        self.palette[palette_id] = char
-                        self.auto_char_map[block_name] = char
-                        print(f"识别到特殊条件方块 {block_name} -> {char}")
-                        matched_special = True
-                        break  # 匹配到一个关键词即退出循环
-                if matched_special:
-                    break  # 已匹配特殊字符，退出外层循环
-            if matched_special:
-                continue  # 继续处理下一个方块
-
-            matched_complex = False
-            for char, config in self.config['complex_conditions'].items():
-                keywords = config.get('keywords', [])
-                for keyword in keywords:
-                    if keyword.lower() in block_name.lower():
-                        self.palette[palette_id] = char
-                        self.auto_char_map[block_name] = char
-                        self.used_chars.add(char)
-                        print(f"识别到复杂条件方块 {block_name} -> {char} (关键词: {keyword})")
-                        matched_complex = True
-                        break
-                if matched_complex:
-                    break
-            if matched_complex:
+            if match is not None and match[0] == "special":
+                char = match[1]
+                self.palette[palette_id] = char
+                self.auto_char_map[block_name] = char
+                self._index_block(char, block_name, palette_id)
+                self._log(f"识别到特殊条件方块 {block_name} -> {char}")
                 continue
 
-            # 自动分配字符（使用单符号）
+            if match is not None and match[0] == "complex":
+                _, char, keyword = match
+                self.palette[palette_id] = char
+                self.auto_char_map[block_name] = char
+                self.used_chars.add(char)
+                self._index_block(char, block_name, palette_id)
+                self._log(f"识别到复杂条件方块 {block_name} -> {char} (关键词: {keyword})")
+                continue
+
+            auto_entries.append((block_name, palette_id))
+
+        # 出现次数只决定哪些方块落入扩展字符；同一档内按方块名分配，小幅改动结构不会让字符互换
+        for block_name, palette_id in auto_entries:
+            if self._block_count(palette_id) == 0:
+                self._log(f"方块 {block_name} (ID:{palette_id}) 未在结构中出现，跳过分配")
+        auto_entries = [entry for entry in auto_entries if self._block_count(entry[1]) > 0]
+        primary_capacity = len({symbol for category in CHAR_CATEGORIES for symbol in category} - self.used_chars)
+        auto_entries.sort(key=lambda entry: (-self._block_count(entry[1]), entry[0]))
+        auto_entries = (sorted(auto_entries[:primary_capacity], key=lambda entry: entry[0]) +
+                        sorted(auto_entries[primary_capacity:], key=lambda entry: entry[0]))
+        for block_name, palette_id in auto_entries:
+
+            # 自动分配字符
             if block_name not in self.auto_char_map:
                 try:
                     new_char = next(self.char_generator)
@@ -224,16 +1567,74 @@ class SchematicConverter:
                         new_char = next(self.char_generator)
                     self.auto_char_map[block_name] = new_char
                     self.used_chars.add(new_char)
-                    print(f"自动分配 {block_name} -> {new_char}")
+                    self._log(f"自动分配 {block_name} -> {new_char}")
                 except StopIteration as stop_exception:
                     raise ValueError("单符号资源耗尽，请减少唯一方块种类") from stop_exception
 
             # 更新palette映射
             assigned_char = self.auto_char_map[block_name]
             self.palette[palette_id] = assigned_char
-            print(f"映射 {block_name} (ID:{palette_id}) -> {assigned_char}")
-
-    def _handle_air_block(self, palette_id):
+            self._index_block(assigned_char, block_name, palette_id)
+            self._log(f"映射 {block_name} (ID:{palette_id}) -> {assigned_char}")
+
+        if self.quiet:
+            print(f"调色板共 {len(entries)} 种方块，已全部映射")
+
+    def _block_count(self, palette_id):
+        """方块在结构中的出现次数；尚未解析方块数据时视为出现过"""
+        palette_id = int(palette_id)
+        if self.block_counts is None or palette_id >= self.block_counts.size:
+            return 1
+        return int(self.block_counts[palette_id])
+
+    def _log(self, message):
+        """逐条进度输出，静默模式下忽略"""
+        if not self.quiet:
+            print(message)
+
+    def _index_block(self, char, block_name, palette_id):
+        """记录字符到方块的反向索引"""
+        self.char_index.setdefault(char, []).append((block_name, int(palette_id)))
+
+    def char_counts(self):
+        """各字符在结构中的出现次数（由方块出现次数汇总，复杂度与调色板大小成正比）"""
+        return {char: sum(self._block_count(palette_id) for _, palette_id in blocks)
+                for char, blocks in self.char_index.items()}
+
+    def present_chars(self):
+        """结构中实际出现的字符；尚未统计方块出现次数时退回写出层时收集的字符"""
+        if self.block_counts is None:
+            return set(self.layer_chars)
+        return {char for char, count in self.char_counts().items() if count > 0}
+
+    def block_stats(self):
+        """按出现次数从高到低列出每个字符及其对应方块的出现次数"""
+        stats = []
+        for char, blocks in self.char_index.items():
+            entries = [{'block': block_name, 'palette_id': palette_id, 'count': self._block_count(palette_id)}
+                       for block_name, palette_id in blocks]
+            entries.sort(key=lambda entry: -entry['count'])
+            stats.append({'char': char, 'count': sum(entry['count'] for entry in entries), 'blocks': entries})
+        stats.sort(key=lambda entry: (-entry['count'], entry['char']))
+        return stats
+
+    def write_stats_report(self):
+        """写出每个字符对应方块及出现次数的统计文件，并打印汇总表"""
+        stats = self.block_stats()
+        stats_file = self.output_dir / f"{self.config['class_prefix']}_Stats.json"
+        report = {'size': [self.width, self.height, self.length], 'blocks': self.width * self.height * self.length,
+                  'chars': stats}
+        self._write_text_output(stats_file, json.dumps(report, ensure_ascii=False, indent=2))
+        self._save_manifest()
+
+        print(f"{'字符':<6}{'出现次数':>10}  方块")
+        for entry in stats:
+            blocks = ", ".join(f"{block['block']}({block['count']})" for block in entry['blocks'])
+            char = f"'{java_char_literal(entry['char'])}'"
+            print(f"{char:<8}{entry['count']:>12}  {blocks}")
+        print(f"生成方块统计文件: {stats_file}")
+
+    def _handle_air_block(self, palette_id, block_name="minecraft:air"):
         """特殊处理空气方块"""
         # 修复：确保palette_id是整数，并正确处理所有类型的palette_id
         try:
@@ -246,110 +1647,316 @@ class SchematicConverter:
         self.auto_char_map["minecraft:air"] = ' '
         self.auto_char_map["air"] = ' '
         self.used_chars.add(' ')
+        self._index_block(' ', block_name, palette_id_int)
 
-    def decode_nbt_block_data(self, block_data_tag):
-        """解析NBT方块数据"""
-        self.block_data = []
-
-        # BlockData可能是字节数组或整数数组
-        if hasattr(block_data_tag, '__iter__'):
-            # 直接迭代数组
-            for block_id in block_data_tag:
-                # 确保block_id是palette字典中存在的键
-                if block_id not in self.palette:
-                    # 尝试转换为整数
-                    try:
-                        block_id_int = int(block_id)
-                        if block_id_int in self.palette:
-                            self.block_data.append(block_id_int)
-                            continue
-                    except (ValueError, TypeError):
-                        pass
-                    raise ValueError(f"发现未映射的方块ID: {block_id}")
-                self.block_data.append(block_id)
-        else:
-            # 单个值的情况（理论上不应该出现）
-            block_id = int(block_data_tag)
-            if block_id not in self.palette:
-                raise ValueError(f"发现未映射的方块ID: {block_id}")
-            self.block_data.append(block_id)
-
-        # 数据校验：width * length * height = 块数据总量
+    @profiled_stage
+    def decode_nbt_block_data(self, block_data_tag, palette_ids=None):
+        """解析NBT方块数据（ByteArray按varint解码，IntArray直接转换）并统计各方块出现次数"""
         expected_size = self.width * self.length * self.height
-        if len(self.block_data) != expected_size:
-            raise ValueError(f"数据长度不匹配！预期: {expected_size}, 实际: {len(self.block_data)}")
-
+        out = None
+        if isinstance(block_data_tag, np.memmap):
+            # 原始数组已映射到临时文件时，解码结果同样写入内存映射文件
+            out = np.memmap(self._get_spill_dir() / "block_data.u32", dtype=np.uint32, mode="w+",
+                            shape=(expected_size,))
+        self.block_data = decode_block_data_array(block_data_tag, expected_size, out)
+
+        # 调色板校验：一次max/isin检查代替逐个元素查字典
+        palette_ids = list(self.palette.keys() if palette_ids is None else palette_ids)
+        validate_palette_ids(self.block_data, palette_ids)
+        self.block_counts = count_block_ids(
+            self.block_data, max((int(palette_id) for palette_id in palette_ids), default=-1) + 1
+        )
+
+    def build_char_lut(self):
+        """构建调色板ID到字符的查找表（未映射的ID对应'?'）"""
+        size = max((int(palette_id) for palette_id in self.palette), default=-1) + 1
+        char_lut = np.full(size, '?', dtype='U1')
+        for palette_id, char in self.palette.items():
+            char_lut[int(palette_id)] = char
+        return char_lut
+
+    def block_grid(self):
+        """将方块数据整理为(新Z, Y, 新X)视图：新Z对应原X，新X对应原Z（方向相反）"""
+        # 原始索引公式 index = y * (W * L) + z * W + x，对应形状(H, L, W)
+        grid = np.asarray(self.block_data).reshape(self.height, self.length, self.width)
+        return rotate_block_grid(grid)
+
+    def iter_layers(self, layer_indices=None):
+        """按Z切片惰性生成层数据，每次只保留一层的行字符串"""
+        grid = np.asarray(self.block_data).reshape(self.height, self.length, self.width)
+
+        # Z轴从小到大遍历（每个Z对应一个LAYER），Y轴从下到上不变
+        if layer_indices is None:
+            layer_indices = range(self.width)
+        yield from iter_grid_layers(grid, self.build_char_lut(), layer_indices)
+
+    @profiled_stage
     def generate_layers(self):
-        self.layers = []
-
-        new_width = self.length
-        new_length = self.width
-        # Z轴从小到大遍历（每个Z对应一个LAYER）
-        for z in range(new_length):
-            layer_data = []
-
-            # Y轴从下到上不变
-            for y in range(self.height):
-                row = []
-
-                # 遍历新的X轴（原来的Z轴，但方向相反）
-                for x in range(new_width):
-                    # 计算原始坐标：
-                    # 新的x对应原来的z（但方向相反：new_x = length-1 - original_z）
-                    # 新的z对应原来的x
-                    original_x = z  # 新的z位置对应原来的x坐标
-                    original_z = new_width - 1 - x  # 新的x位置对应原来的z坐标（反向）
-                    original_y = y  # y坐标不变
-
-                    # 使用原始索引公式
-                    index = original_y * (self.width * self.length) + original_z * self.width + original_x
-
-                    if index < len(self.block_data):
-                        block_id = self.block_data[index]
-                        row.append(self.palette.get(block_id, '?'))
-                    else:
-                        row.append('?')  # 索引超出范围
-                layer_data.append("".join(row))
-
-            self.layers.append(layer_data)
+        self.layers = list(self.iter_layers())
 
         return self.layers # 返回实例变量
 
-    def generate_java_code(self, data):
-        """生成Java结构类文件"""
-        total_files = (len(data) + DEFAULT_LAYERS_PER_FILE - 1) // DEFAULT_LAYERS_PER_FILE
-        for file_num in range(total_files):
-            start = file_num * DEFAULT_LAYERS_PER_FILE
-            end = min((file_num + 1) * DEFAULT_LAYERS_PER_FILE, len(data))
-            file_layers = data[start:end]
-
-            class_name = f"{self.config['class_prefix']}_Part{file_num + 1}"
-            code = [
-                f"package {self.config['package_name']}.{Path(self.config['INPUT_FILE']).stem};",
-                "",
-                f"public class {class_name} {{",
-                ""
-            ]
-
-            # 修正：每个文件内的层号应该从1开始，而不是start+1
-            for i, layer in enumerate(file_layers, 1):  # 改为从1开始
-                code.append(f"    public static final String[] LAYER_{i:03} = {{")
-                code.extend([f'        "{row}",' for row in layer])
-                code.append("    };\n")
-
-            code.append("}")
+    def _iter_layer_codes(self, layer_indices):
+        """按给定的原X索引逐层生成(行, 列)字符码点数组，与iter_layers的行顺序一致"""
+        grid = np.asarray(self.block_data).reshape(self.height, self.length, self.width)
+        # U1字符数组的底层就是UCS-4码点，直接作为uint32查找表使用
+        code_lut = self.build_char_lut().view(np.uint32)
+        yield from iter_grid_layer_codes(grid, code_lut, layer_indices)
+
+    @profiled_stage
+    def plan_layers(self):
+        """返回(需要写出的源层索引, 每个源层对应的写出层序号)
+
+        启用dedupe_layers时按字符内容哈希每一层，相同的层只写出一次。
+        """
+        if not self.config.get('dedupe_layers'):
+            return range(self.width), range(self.width)
+
+        layer_numbers = {}
+        unique_layers = []
+        sequence = []
+        for layer_index, codes in enumerate(self._iter_layer_codes(range(self.width))):
+            digest = hashlib.blake2b(codes.tobytes(), digest_size=16).digest()
+            if digest not in layer_numbers:
+                layer_numbers[digest] = len(unique_layers)
+                unique_layers.append(layer_index)
+            sequence.append(layer_numbers[digest])
+
+        print(f"层去重: {self.width} 层 -> {len(unique_layers)} 个不同的层")
+        return unique_layers, sequence
+
+    def layers_per_part(self):
+        """按当前结构的行数和行长计算每个Part类的层数"""
+        char_bytes = max(len(char.encode("utf-8")) for char in self.used_chars | {' '})
+        # 旋转后每层有height行，每行length个字符
+        return layers_per_part(self.height, self.length * char_bytes, self.config.get('layers_per_file'))
+
+    def _part_chunks(self, layer_indices):
+        """将需要写出的层按每个Part的容量分组"""
+        part_size = self.layers_per_part()
+        return [layer_indices[start:start + part_size]
+                for start in range(0, len(layer_indices), part_size)]
+
+    @profiled_stage
+    def generate_java_code(self, data=None):
+        """生成Java结构类文件（逐层流式写出，同时收集aisle引用和已用字符）"""
+        self.part_layer_refs = []
+        self.layer_chars = set()
+        if data is not None:
+            self._generate_java_code_from_layers(iter(data))
+            self.aisle_refs = list(self.part_layer_refs)
+            return
+
+        layer_indices, sequence = self.plan_layers()
+        # 已统计方块出现次数时由反向索引得到已用字符，写出时不再逐行收集
+        if self.block_counts is not None:
+            self.layer_chars = self.present_chars()
+        if self.config.get('output_mode', "java") == "resource":
+            self._generate_layer_resource(layer_indices, sequence)
+            self._remove_stale_parts()
+            self._save_manifest()
+            return
+
+        parts = []
+        for file_num, chunk in enumerate(self._part_chunks(layer_indices), 1):
+            class_name = f"{self.config['class_prefix']}_Part{file_num}"
+            parts.append((self.output_dir / f"{class_name}.java", class_name, chunk))
+        self._write_parts(parts, self.config.get('jobs', 1) or os.cpu_count() or 1)
+
+        self.aisle_refs = [self.part_layer_refs[layer_number] for layer_number in sequence]
+        self._remove_stale_parts()
+        self._save_manifest()
+
+    def _generate_layer_resource(self, layer_indices, sequence):
+        """写出游程编码的层资源文件和运行时展开它的Java加载类"""
+        loader_name = f"{self.config['class_prefix']}_Layers"
+        resource_file = self.output_dir / f"{self.config['class_prefix']}_layers.bin"
+        # 连续相同的aisle只在去重模式下合并为重复次数，与String[]输出模式保持一致
+        if self.config.get('dedupe_layers'):
+            aisle_runs = [(layer_number, sum(1 for _ in group))
+                          for layer_number, group in itertools.groupby(sequence)]
+        else:
+            aisle_runs = [(layer_number, 1) for layer_number in sequence]
+
+        used_codes = set()
+        # mtime固定为0，使相同内容的资源文件逐字节一致，便于清单和缓存比较
+        with open(self.sink.temp_path(resource_file), "wb") as raw, \
+                gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as writer:
+            writer.write(LAYER_RESOURCE_MAGIC + struct.pack(
+                ">iiii", LAYER_RESOURCE_VERSION, len(layer_indices), self.height, self.length
+            ))
+            for codes in self._iter_layer_codes(layer_indices):
+                if self.block_counts is None:
+                    used_codes.update(np.unique(codes).tolist())
+                writer.write(encode_layer_runs(codes))
+            writer.write(struct.pack(">i", len(aisle_runs)))
+            writer.write(np.array(aisle_runs, dtype='>i4').reshape(-1, 2).tobytes())
+
+        if self._commit_output(resource_file):
+            print(f"生成层资源文件: {resource_file}")
+        else:
+            print(f"层资源文件内容未变化，保留原文件: {resource_file}")
+
+        loader_code = LAYER_LOADER_TEMPLATE.substitute(
+            package_line=self._package_line(), class_name=loader_name, resource_name=resource_file.name,
+            magic=f"0x{LAYER_RESOURCE_MAGIC.hex().upper()}", version=LAYER_RESOURCE_VERSION
+        )
+        loader_file = self.output_dir / f"{loader_name}.java"
+        if self._write_text_output(loader_file, loader_code):
+            print(f"生成层加载类文件: {loader_file}")
+        else:
+            print(f"层加载类文件内容未变化，保留原文件: {loader_file}")
+        print(f"提示: 请将 {resource_file.name} 放入资源目录中与 {loader_name} 相同包路径下")
+
+        self.layer_chars.update(chr(code) for code in used_codes)
+        self.part_layer_refs = [f"{loader_name}.layer({layer_number})" for layer_number in range(len(layer_indices))]
+        self.aisle_refs = [self.part_layer_refs[layer_number] for layer_number in sequence]
+
+    def _generate_java_code_from_layers(self, layers):
+        """将外部传入的层数据按每个Part的容量分组流式写出"""
+        part_size = self.layers_per_part()
+        package_line = self._package_line()
+        escape_table = java_escape_table(self.palette.values())
+        for file_num in itertools.count(1):
+            file_layers = itertools.islice(layers, part_size)
+            first_layer = next(file_layers, None)
+            if first_layer is None:
+                break
+
+            class_name = f"{self.config['class_prefix']}_Part{file_num}"
             output_file = self.output_dir / f"{class_name}.java"
-
-            # 删除重复的写入操作，只写一次文件
-            output_file.write_text("\n".join(code), encoding="utf-8")
+            layer_count, layer_chars = write_part_file(
+                self.sink.temp_path(output_file), package_line, class_name,
+                itertools.chain([first_layer], file_layers), escape_table
+            )
+            self._record_part(output_file, class_name, layer_count, layer_chars)
+
+        self._remove_stale_parts()
+        self._save_manifest()
+
+    def _write_parts(self, parts, jobs):
+        """写出各Part文件；设置了part_cache时，源签名未变化且输出文件未被改动的Part直接沿用"""
+        package_line = self._package_line()
+        signatures = {}
+        reused = {}
+        if self.part_cache is not None:
+            for output_file, class_name, chunk in parts:
+                signature = self._part_signature(package_line, class_name, chunk)
+                signatures[output_file.name] = signature
+                cached = self.part_cache.get(output_file.name)
+                if cached is not None and cached[0] == signature and self.sink.reuse(output_file):
+                    reused[output_file.name] = cached[1:]
+
+        pending = [part for part in parts if part[0].name not in reused]
+        if jobs > 1 and len(pending) > 1:
+            results = self._iter_parts_parallel(pending, jobs)
+        else:
+            results = self._iter_parts_serial(pending)
+
+        # 按Part顺序记录，保证aisle引用顺序与结构一致
+        for output_file, class_name, _ in parts:
+            if output_file.name in reused:
+                layer_count, layer_chars = reused[output_file.name]
+                print(f"结构类文件的源层未变化，跳过生成: {output_file}")
+                self.part_layer_refs.extend(f"{class_name}.LAYER_{i:03}" for i in range(1, layer_count + 1))
+                self.layer_chars.update(layer_chars)
+            else:
+                layer_count, layer_chars = next(results)
+                self._record_part(output_file, class_name, layer_count, layer_chars)
+            if self.part_cache is not None:
+                self.part_cache[output_file.name] = (signatures[output_file.name], layer_count, layer_chars)
+
+    def _part_signature(self, package_line, class_name, layer_indices):
+        """Part的源签名：包名、类名和各层字符码点的哈希"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{TOOL_VERSION}\0{package_line}\0{class_name}\0{self.height}x{self.length}".encode("utf-8"))
+        for codes in self._iter_layer_codes(layer_indices):
+            digest.update(codes.tobytes())
+        return digest.hexdigest()
+
+    def _iter_parts_serial(self, parts):
+        """在当前进程中依次写出Part文件，逐个返回(层数, 已用字符)"""
+        package_line = self._package_line()
+        escape_table = java_escape_table(self.palette.values())
+        collect_chars = self.block_counts is None
+        for output_file, class_name, chunk in parts:
+            yield write_part_file(
+                self.sink.temp_path(output_file), package_line, class_name, self.iter_layers(chunk), escape_table,
+                collect_chars
+            )
+
+    def _iter_parts_parallel(self, parts, jobs):
+        """通过进程池并行写出各Part文件，按提交顺序返回(层数, 已用字符)；方块数据经内存映射文件共享"""
+        package_line = self._package_line()
+        char_lut = self.build_char_lut()
+        escape_table = java_escape_table(self.palette.values())
+        shape = (self.height, self.length, self.width)
+
+        owns_block_file = not (isinstance(self.block_data, np.memmap) and self.block_data.offset == 0)
+        if owns_block_file:
+            fd, block_file = tempfile.mkstemp(suffix=".u32")
+            os.close(fd)
+        else:
+            # 流式加载的方块数据本身就是内存映射文件，直接共享给工作进程
+            self.block_data.flush()
+            block_file = self.block_data.filename
+        try:
+            if owns_block_file:
+                shared = np.memmap(block_file, dtype=np.uint32, mode='w+', shape=(self.block_data.size,))
+                shared[:] = self.block_data
+                shared.flush()
+                del shared
+
+            collect_chars = self.block_counts is None
+            tasks = [(block_file, shape, char_lut, escape_table, chunk,
+                      self.sink.temp_path(output_file), package_line, class_name, collect_chars)
+                     for output_file, class_name, chunk in parts]
+
+            with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+                # map按提交顺序返回结果，保证aisle引用顺序与串行一致
+                yield from executor.map(_write_part_worker, tasks)
+        finally:
+            if owns_block_file:
+                os.remove(block_file)
+
+    def _package_line(self):
+        return f"package {self.config['package_name']}.{structure_name(self.config)};"
+
+    def _record_part(self, output_file, class_name, layer_count, layer_chars):
+        """提交一个已写入临时文件的Part，并记录其aisle引用和已用字符"""
+        if self._commit_output(output_file):
             print(f"生成结构类文件: {output_file}")
+        else:
+            print(f"结构类文件内容未变化，保留原文件: {output_file}")
+        self.part_layer_refs.extend(f"{class_name}.LAYER_{i:03}" for i in range(1, layer_count + 1))
+        self.layer_chars.update(layer_chars)
+
+    @property
+    def output_files(self):
+        """本次转换写出的全部文件"""
+        return self.sink.output_files
+
+    def _write_text_output(self, output_file, text):
+        """写出文本文件（内容未变化时不改动原文件），返回是否实际写入"""
+        return self.sink.write_text(output_file, text)
+
+    def _commit_output(self, output_file):
+        """提交已写入临时文件的输出，返回内容是否有变化"""
+        return self.sink.commit(output_file)
 
+    def _save_manifest(self):
+        self.sink.save_manifest()
+
+    def _remove_stale_parts(self):
+        self.sink.remove_stale(self.config['class_prefix'])
+
+    @profiled_stage
     def generate_pattern_code_snippet(self):
         """生成主模式类文件（只包含aisle部分，返回Builder）"""
         main_class_name = self.config['class_prefix']
 
         code = [
-            f"package {self.config['package_name']}.{Path(self.config['INPUT_FILE']).stem};",
+            f"package {self.config['package_name']}.{structure_name(self.config)};",
             "",
             "import com.gregtechceu.gtceu.api.pattern.FactoryBlockPattern;",
             "",
@@ -358,33 +1965,49 @@ class SchematicConverter:
             f"    public static final FactoryBlockPattern PATTERN = {DEFAULT_BASE_STRUCTURE};",
         ]
 
-        # 生成所有层的aisle调用
-        total_layers = len(self.layers)
-        for layer_idx in range(total_layers):
-            part_num = (layer_idx // DEFAULT_LAYERS_PER_FILE) + 1
-            layer_in_part = (layer_idx % DEFAULT_LAYERS_PER_FILE) + 1
-            class_name = f"{self.config['class_prefix']}_Part{part_num}"
-            layer_ref = f"{class_name}.LAYER_{layer_in_part:03}"
-            code.append(f"                .aisle({layer_ref})")
+        aisle_refs = self.aisle_refs
+        if self.config.get('output_mode', "java") == "resource":
+            # 资源模式下aisle顺序保存在资源文件中，由加载类在运行时依次调用
+            code[-1] = f"    public static final FactoryBlockPattern PATTERN = " \
+                       f"{main_class_name}_Layers.aisles({DEFAULT_BASE_STRUCTURE});"
+            aisle_refs = []
+
+        # 生成所有层的aisle调用（引用在写出Part文件时已收集）；
+        # 启用层去重时，连续相同的aisle合并为一次调用并设置重复次数
+        code_bytes = 3 + 3  # start()调用 + putstatic
+        for layer_ref, group in itertools.groupby(aisle_refs):
+            repeat = sum(1 for _ in group)
+            if repeat > 1 and self.config.get('dedupe_layers'):
+                code.append(f"                .aisle({layer_ref}).setRepeatable({repeat})")
+                code_bytes += 3 + 3 + _int_push_cost(repeat)[0] + 3
+            else:
+                code.extend([f"                .aisle({layer_ref})"] * repeat)
+                code_bytes += (3 + 3) * repeat  # getstatic + invokevirtual
+
+        if code_bytes > JAVA_METHOD_CODE_LIMIT * PART_BUDGET_RATIO:
+            print(f"警告: 主模式类的aisle调用约需 {code_bytes} 字节码，可能超过Java方法上限 {JAVA_METHOD_CODE_LIMIT}，"
+                  f"可尝试启用--dedupe-layers")
 
         code.append("    }")
         code.append("}")
 
         output_file = self.output_dir / f"{main_class_name}.java"
-        output_file.write_text("\n".join(code), encoding="utf-8")
-        print(f"生成主模式类文件: {output_file}")
+        if self._write_text_output(output_file, "\n".join(code)):
+            print(f"生成主模式类文件: {output_file}")
+        else:
+            print(f"主模式类文件内容未变化，保留原文件: {output_file}")
 
         # 单独生成.where()条件和.build()用于手动粘贴
         self.generate_conditions_for_manual_paste()
+        if self.config.get('stats'):
+            self.write_stats_report()
 
+    @profiled_stage
     def generate_conditions_for_manual_paste(self):
         """生成单独的.where()条件和.build()，用于手动粘贴到机器类"""
         conditions_code = []
 
-        unique_chars = set()
-        for layer in self.layers:
-            for row in layer:
-                unique_chars.update(row)
+        unique_chars = self.layer_chars
 
         processed_chars = set()
 
@@ -402,13 +2025,13 @@ class SchematicConverter:
                 # 处理特殊字符（如~）
                 config = self.config['SPECIAL_CHARS'][char]
                 # 修复：特殊字符条件不需要格式化
-                conditions_code.append(f"                .where('{char}', {config['condition']})")
+                conditions_code.append(f"                .where('{java_char_literal(char)}', {config['condition']})")
                 processed_chars.add(char)
 
             elif char in self.config['complex_conditions']:
                 # 处理复杂条件（如A）
                 config = self.config['complex_conditions'][char]
-                matched_blocks = [k for k, v in self.auto_char_map.items() if v == char]
+                matched_blocks = [block_name for block_name, _ in self.char_index.get(char, [])]
                 if matched_blocks:
                     base_condition = config['condition'].format(matched_blocks[0])
 
@@ -420,15 +2043,15 @@ class SchematicConverter:
                                 condition_lines.append(f"                    .or({or_condition})")
 
                     complex_condition = "\n".join(condition_lines)
-                    conditions_code.append(f"                .where('{char}', {complex_condition})")
+                    conditions_code.append(f"                .where('{java_char_literal(char)}', {complex_condition})")
                     processed_chars.add(char)
 
             else:
                 # 处理普通字符
-                matched_blocks = [k for k, v in self.auto_char_map.items() if v == char]
+                matched_blocks = [block_name for block_name, _ in self.char_index.get(char, [])]
                 if matched_blocks:
                     condition = f"Predicates.blocks(GetRegistries.getBlock('{matched_blocks[0]}'))"
-                    conditions_code.append(f"                .where('{char}', {condition})")
+                    conditions_code.append(f"                .where('{java_char_literal(char)}', {condition})")
                     processed_chars.add(char)
 
         # 添加.build()
@@ -436,7 +2059,8 @@ class SchematicConverter:
 
         # 保存条件文件
         conditions_output_file = self.output_dir / f"{self.config['class_prefix']}_WhereConditions.txt"
-        conditions_output_file.write_text("\n".join(conditions_code), encoding="utf-8")
+        self._write_text_output(conditions_output_file, "\n".join(conditions_code))
+        self._save_manifest()
         print(f"生成.where()条件和.build()文件: {conditions_output_file}")
 
     def _build_complex_condition(self, char, config, indent=4):
@@ -455,29 +2079,781 @@ class SchematicConverter:
         return '\n'.join(condition_lines)
 
 
+# ----------------------
+# 构建缓存
+# ----------------------
+class BuildCache:
+    """以输入文件内容、转换配置和工具版本为键的输出缓存"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES, max_age=DEFAULT_CACHE_MAX_AGE):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def key(self, config):
+        """计算缓存键：输入文件字节 + 影响输出的配置 + 工具版本"""
+        output_config = {k: v for k, v in config.items() if k not in CACHE_IGNORED_KEYS}
+        output_config['INPUT_STEM'] = structure_name(config)
+        digest = hashlib.sha256()
+        digest.update(TOOL_VERSION.encode("utf-8"))
+        digest.update(json.dumps(output_config, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        # 分块转换时由主进程预先计算输入文件哈希，各分块不再重复读取整个输入文件
+        digest.update((config.get('input_digest') or _file_digest(config['INPUT_FILE'])).encode("utf-8"))
+        return digest.hexdigest()
+
+    def restore(self, key, sink):
+        """命中缓存时把缓存的输出文件提交到DirectorySink（内容未变化的文件保持不动），返回是否命中"""
+        entry_dir = self.cache_dir / key
+        manifest_file = entry_dir / "manifest.json"
+        if not manifest_file.is_file():
+            return False
+        try:
+            manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+            # 先校验整个条目，未命中时不改动输出目录
+            for name, digest in manifest['files'].items():
+                cached_file = entry_dir / name
+                if not cached_file.is_file() or _file_digest(cached_file) != digest:
+                    return False
+            for name in manifest['files']:
+                output_file = sink.output_dir / name
+                # copyfile不保留缓存文件的修改时间，内容变化的文件在输出目录中是新的修改时间
+                shutil.copyfile(entry_dir / name, sink.temp_path(output_file))
+                sink.commit(output_file)
+        except (OSError, ValueError, KeyError):
+            return False
+
+        # 更新访问时间，淘汰时按最近使用排序
+        os.utime(entry_dir)
+        return True
+
+    def store(self, key, output_files):
+        """保存本次转换的输出文件并执行淘汰"""
+        entry_dir = self.cache_dir / key
+        staging_dir = self.cache_dir / f"{key}.tmp{os.getpid()}"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True)
+
+        files = {}
+        for output_file in output_files:
+            output_file = Path(output_file)
+            shutil.copy2(output_file, staging_dir / output_file.name)
+            files[output_file.name] = _file_digest(output_file)
+        (staging_dir / "manifest.json").write_text(
+            json.dumps({'tool_version': TOOL_VERSION, 'files': files}, ensure_ascii=False, indent=2),
+            encoding="utf-8"
+        )
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(staging_dir, entry_dir)
+        self.evict()
+
+    def evict(self):
+        """按时间和总大小淘汰过期缓存条目"""
+        if not self.cache_dir.is_dir():
+            return
+        now = time.time()
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            if not entry_dir.is_dir() or ".tmp" in entry_dir.name:
+                continue
+            mtime = entry_dir.stat().st_mtime
+            if now - mtime > self.max_age:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            size = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+            entries.append((mtime, size, entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+
+# ----------------------
+# 监视模式
+# ----------------------
+class WatchSession:
+    """监视模式的常驻状态：共享的调色板分类器，以及每个文件的输入签名、输出清单和Part源签名"""
+
+    def __init__(self, base_config):
+        self.base_config = base_config
+        self.classifier = PaletteClassifier(base_config['SPECIAL_CHARS'], base_config['complex_conditions'])
+        self.states = {}  # 输入文件 -> 上次转换的状态
+
+    def sync(self, input_files):
+        """转换新增或内容有变化的文件，返回本轮转换的文件数"""
+        converted = 0
+        for input_file in input_files:
+            try:
+                stat = input_file.stat()
+            except OSError:
+                continue
+            state = self.states.setdefault(input_file, {'stat': None, 'digest': None, 'manifest': None,
+                                                        'part_cache': {}})
+            if state['stat'] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            state['stat'] = (stat.st_size, stat.st_mtime_ns)
+            # 只改动了修改时间（例如重新保存相同内容）时不重新转换
+            digest = _file_digest(input_file)
+            if digest == state['digest']:
+                continue
+
+            start_time = time.perf_counter()
+            try:
+                output_dir = self.convert(input_file, state)
+                state['digest'] = digest
+                print(f"[成功] {input_file} -> {output_dir} ({(time.perf_counter() - start_time) * 1000:.0f}ms)")
+            except Exception as err:
+                # 文件可能仍在写入，下次修改时间变化后会重试
+                print(f"[失败] {input_file}: {err}")
+            converted += 1
+
+        for input_file in set(self.states) - set(input_files):
+            del self.states[input_file]
+        return converted
+
+    def convert(self, input_file, state):
+        """使用常驻状态转换单个文件，只重新生成源层有变化的Part"""
+        config = dict(self.base_config, INPUT_FILE=str(input_file))
+        if config.get('output_dir'):
+            # 多个文件共用输出根目录时按结构名分开，否则各自删除多余Part时会删掉对方的文件
+            config['output_dir'] = str(Path(config['output_dir']) / structure_name(config))
+        sink = output_sink(config)
+        sink.manifest = state['manifest']
+        converter = SchematicConverter(config, sink, classifier=self.classifier)
+        converter.part_cache = state['part_cache']
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            converter.load_schematic(config['INPUT_FILE'])
+            converter.generate_java_code()
+            converter.generate_pattern_code_snippet()
+        state['manifest'] = sink.manifest
+        return converter.output_dir
+
+
+class InotifyWatcher:
+    """通过ctypes调用Linux inotify监视目录（不递归子目录）"""
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # IN_NONBLOCK和IN_CLOEXEC与对应的O_*标志取值相同
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"无法监视目录: {directory}")
+
+    def wait(self, timeout):
+        """等待目录变化事件，超时返回False；读出并丢弃已到达的全部事件"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except BlockingIOError:
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """按固定间隔比较结构文件的大小和修改时间"""
+
+    def __init__(self, pattern, interval=DEFAULT_WATCH_INTERVAL):
+        self.pattern = pattern
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for input_file in collect_schematic_files(self.pattern):
+            try:
+                stat = input_file.stat()
+            except OSError:
+                continue
+            snapshot[input_file] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+def create_watcher(pattern, interval=DEFAULT_WATCH_INTERVAL):
+    """优先使用inotify监视目录，不可用（非Linux、递归通配符等）时退回轮询"""
+    path = Path(pattern)
+    directory = path if path.is_dir() else path.parent
+    if sys.platform.startswith("linux") and "**" not in pattern and not glob.has_magic(str(directory)):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError) as err:
+            print(f"inotify不可用（{err}），改用轮询")
+    return PollingWatcher(pattern, interval)
+
+
+def run_watch(pattern, base_config, interval=DEFAULT_WATCH_INTERVAL):
+    """监视目录或通配符匹配的结构文件，变化后在当前进程中增量重新转换，Ctrl+C退出"""
+    session = WatchSession(base_config)
+    print(f"首次转换: {pattern}")
+    session.sync(collect_schematic_files(pattern))
+
+    watcher = create_watcher(pattern, interval)
+    print(f"正在监视 {pattern}（{type(watcher).__name__}），按Ctrl+C退出...")
+    try:
+        while True:
+            if not watcher.wait(interval):
+                continue
+            # 导出工具通常分多次写入，等待写入完成后再读取
+            time.sleep(DEFAULT_WATCH_DEBOUNCE)
+            watcher.wait(0)
+            session.sync(collect_schematic_files(pattern))
+    except KeyboardInterrupt:
+        print("停止监视")
+    finally:
+        watcher.close()
+    return 0
+
+
+# ----------------------
+# 输出校验
+# ----------------------
+WHERE_LINE_PATTERN = re.compile(r"^\s*\.where\('(\\u[0-9A-Fa-f]{4}|.)',\s*(.*)$", re.MULTILINE)
+GET_BLOCK_PATTERN = re.compile(r"getBlock\('([^']*)'\)")
+LAYER_CONSTANT_PATTERN = re.compile(r"public static final String\[\] (LAYER_\d+) = \{\n(.*?)\n    \};", re.DOTALL)
+AISLE_CALL_PATTERN = re.compile(r"\.aisle\((\w+)\.(LAYER_\d+)\)(?:\.setRepeatable\((\d+)\))?")
+JAVA_ESCAPE_PATTERN = re.compile(r"\\u([0-9A-Fa-f]{4})")
+
+
+def _java_unescape(text):
+    if "\\u" not in text:
+        return text
+    return JAVA_ESCAPE_PATTERN.sub(lambda match: chr(int(match.group(1), 16)), text)
+
+
+def parse_where_conditions(text):
+    """解析.where()条件文件，返回[(字符, 条件首行)]"""
+    return [(_java_unescape(char), condition) for char, condition in WHERE_LINE_PATTERN.findall(text)]
+
+
+def _rows_to_codes(rows, height, length, layer_name):
+    """将一层的行字符串转换为(行, 列)码点数组"""
+    if len(rows) != height or any(len(row) != length for row in rows):
+        raise ValueError(f"{layer_name} 的尺寸与结构不符：应为 {height} 行 x {length} 列")
+    if height == 0 or length == 0:
+        return np.zeros((height, length), dtype=np.uint32)
+    return np.frombuffer("".join(rows).encode("utf-32-le"), dtype="<u4").reshape(height, length)
+
+
+def parse_java_layers(files, main_class_name, height, length):
+    """从主模式类和Part类源码还原每个aisle的层码点数组（相同的层共享同一个数组）"""
+    parsed_parts = {}
+    layers = []
+    for part_name, layer_name, repeat in AISLE_CALL_PATTERN.findall(files[f"{main_class_name}.java"]):
+        if part_name not in parsed_parts:
+            source = files.get(f"{part_name}.java")
+            if source is None:
+                raise ValueError(f"缺少结构类文件: {part_name}.java")
+            parsed_parts[part_name] = {
+                name: _rows_to_codes(
+                    [_java_unescape(row.strip()[1:-2]) for row in body.split("\n")] if body.strip() else [],
+                    height, length, f"{part_name}.{name}"
+                )
+                for name, body in LAYER_CONSTANT_PATTERN.findall(source)
+            }
+        layer = parsed_parts[part_name].get(layer_name)
+        if layer is None:
+            raise ValueError(f"{part_name}.java 中缺少常量 {layer_name}")
+        layers.extend([layer] * int(repeat or 1))
+    return layers
+
+
+def parse_layer_resource(data, height, length):
+    """解析资源输出模式的层资源文件，返回每个aisle的层码点数组"""
+    raw = gzip.decompress(data)
+    if raw[:4] != LAYER_RESOURCE_MAGIC:
+        raise ValueError("层资源文件格式不正确")
+    version, layer_count, row_count, row_length = struct.unpack_from(">iiii", raw, 4)
+    if version != LAYER_RESOURCE_VERSION:
+        raise ValueError(f"不支持的层资源文件版本: {version}")
+    if (row_count, row_length) != (height, length):
+        raise ValueError(f"层资源文件尺寸 {row_count}x{row_length} 与结构不符")
+
+    position = 20
+    unique_layers = []
+    for _ in range(layer_count):
+        (run_count,) = struct.unpack_from(">i", raw, position)
+        position += 4
+        runs = np.frombuffer(raw, dtype=LAYER_RESOURCE_RUN_DTYPE, count=run_count, offset=position)
+        position += run_count * LAYER_RESOURCE_RUN_DTYPE.itemsize
+        codes = np.repeat(runs['symbol'].astype(np.uint32), runs['length'])
+        if codes.size != height * length:
+            raise ValueError("层资源文件中的层数据长度与结构不符")
+        unique_layers.append(codes.reshape(height, length))
+
+    (aisle_count,) = struct.unpack_from(">i", raw, position)
+    aisles = np.frombuffer(raw, dtype=">i4", count=aisle_count * 2, offset=position + 4).reshape(-1, 2)
+    return [unique_layers[layer_number] for layer_number, repeat in aisles.tolist() for _ in range(repeat)]
+
+
+def read_output_files(output_dir):
+    """读取输出目录中的生成文件，返回 文件名 -> 文本（.bin为bytes）"""
+    files = {}
+    for output_file in Path(output_dir).iterdir():
+        if output_file.suffix == ".bin":
+            files[output_file.name] = output_file.read_bytes()
+        elif output_file.suffix in (".java", ".txt"):
+            files[output_file.name] = output_file.read_text(encoding="utf-8")
+    return files
+
+
+def expected_char_lut(converter, conditions):
+    """按.where()条件计算每个调色板ID应当生成的字符码点；任何条件都不接受的ID为0xFFFFFFFF"""
+    config = converter.config
+    special_keywords = {
+        char: {keyword.lower() for keyword in char_config.get('keywords', [])}
+        for char, char_config in config['SPECIAL_CHARS'].items()
+    }
+    acceptors = []
+    for char, condition in conditions:
+        block_match = GET_BLOCK_PATTERN.search(condition)
+        if char == ' ':
+            acceptors.append((char, lambda name: name in ("minecraft:air", "air")))
+        elif char in special_keywords:
+            acceptors.append((char, lambda name, keywords=special_keywords[char]: name.lower() in keywords))
+        elif block_match is not None:
+            acceptors.append((char, lambda name, block=block_match.group(1): name == block))
+        elif char in config['complex_conditions']:
+            # 条件模板中没有方块名时按配置的关键词子串匹配
+            keywords = [keyword.lower() for keyword in config['complex_conditions'][char].get('keywords', [])]
+            acceptors.append((char, lambda name, keywords=keywords: any(k in name.lower() for k in keywords)))
+
+    max_id = max(converter.palette_names, default=-1)
+    if converter.block_data.size:
+        max_id = max(max_id, int(np.max(converter.block_data)))
+    lut = np.full(max_id + 1, 0xFFFFFFFF, dtype=np.uint32)
+    for palette_id, block_name in converter.palette_names.items():
+        for char, accepts in acceptors:
+            if accepts(block_name):
+                lut[palette_id] = ord(char)
+                break
+    return lut
+
+
+def verify_output(config, files=None, max_report=DEFAULT_VERIFY_REPORT):
+    """把生成的层和.where()条件还原为方块，与源结构逐格比较
+
+    files为 文件名 -> 内容（例如MemorySink.files），缺省时读取输出目录。
+    返回包含比较格数、不一致数量和前max_report个不一致坐标的字典。
+    """
+    config = {**default_config(), **config}
+    converter = SchematicConverter(config)
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        converter.load_schematic(config['INPUT_FILE'])
+    if files is None:
+        files = read_output_files(converter.output_dir)
+
+    prefix = config['class_prefix']
+    height, length, width = converter.height, converter.length, converter.width
+    if config.get('output_mode', "java") == "resource":
+        layers = parse_layer_resource(files[f"{prefix}_layers.bin"], height, length)
+    else:
+        layers = parse_java_layers(files, prefix, height, length)
+    if len(layers) != width:
+        raise ValueError(f"生成的aisle数量 {len(layers)} 与结构宽度 {width} 不符")
+
+    lut = expected_char_lut(converter, parse_where_conditions(files[f"{prefix}_WhereConditions.txt"]))
+    grid = np.asarray(converter.block_data).reshape(height, length, width)
+    offset_x, offset_y, offset_z = converter.trim_offset
+    mismatches = 0
+    samples = []
+    for slab_start in range(0, width, DEFAULT_LAYER_SLAB):
+        slab_stop = min(slab_start + DEFAULT_LAYER_SLAB, width)
+        block_slab = rotate_block_grid(np.ascontiguousarray(grid[:, :, slab_start:slab_stop]))
+        expected = lut.take(block_slab)
+        generated = np.stack(layers[slab_start:slab_stop])
+        differs = expected != generated
+        count = int(np.count_nonzero(differs))
+        if not count:
+            continue
+        mismatches += count
+        for layer, row, column in zip(*np.nonzero(differs)):
+            if len(samples) >= max_report:
+                break
+            # 层内第row行对应Y，第column列对应反向的Z
+            block_id = int(block_slab[layer, row, column])
+            samples.append({
+                'x': slab_start + int(layer) + offset_x,
+                'y': int(row) + offset_y,
+                'z': length - 1 - int(column) + offset_z,
+                'block': converter.palette_names.get(block_id, f"<未知ID {block_id}>"),
+                'generated': chr(int(generated[layer, row, column]))
+            })
+
+    return {'input_file': str(config['INPUT_FILE']), 'blocks': width * height * length,
+            'mismatches': mismatches, 'samples': samples}
+
+
+def print_verify_report(result):
+    if not result['mismatches']:
+        print(f"校验通过: {result['input_file']}（{result['blocks']} 格全部一致）")
+        return
+    print(f"校验失败: {result['input_file']} 有 {result['mismatches']}/{result['blocks']} 格不一致")
+    for sample in result['samples']:
+        print(f"  ({sample['x']}, {sample['y']}, {sample['z']}): 源方块 {sample['block']}，"
+              f"生成字符 '{java_char_literal(sample['generated'])}'")
+
+
 # ----------------------
 # 执行入口
 # ----------------------
-if __name__ == "__main__":
+def convert_schematic(config, sink=None):
+    """按配置完成一次完整转换，返回输出目录（输入与配置未变化时直接使用缓存）
+
+    config只需提供INPUT_FILE，其余项缺省时取default_config()；
+    sink为MemorySink时生成结果保存在sink.files中，不写入输出目录，也不使用缓存。
+    """
+    config = {**default_config(), **config}
+    if sink is None:
+        sink = output_sink(config)
+
+    cache = cache_key = None
+    # 输出副产物.schem或剖析性能时总是完整转换
+    if isinstance(sink, DirectorySink) and config.get('cache', True) \
+            and not config.get('clean_output') and not config.get('profile'):
+        cache = BuildCache(config.get('cache_dir', DEFAULT_CACHE_DIR))
+        cache_key = cache.key(config)
+        if cache.restore(cache_key, sink):
+            # 缓存条目只包含该次转换的文件，另一版本结构遗留的多余Part同样需要删除
+            sink.remove_stale(config['class_prefix'])
+            sink.save_manifest()
+            print(f"输入与配置未变化，使用缓存结果: {sink.output_dir}")
+            return sink.output_dir
+
+    converter = SchematicConverter(config, sink)
+    if config.get('profile'):
+        converter.profiler = StageProfiler(cprofile=config.get('profile_cprofile', False))
+    print(f"正在解析结构文件: {config['INPUT_FILE']}")
+    converter.load_schematic(config['INPUT_FILE'])
+
+    print("逐层生成层级数据并写出Java结构类...")
+    converter.generate_java_code()
+
+    print("生成主模式类和条件文件...")
+    converter.generate_pattern_code_snippet()
+
+    if cache is not None:
+        cache.store(cache_key, converter.output_files)
+    if converter.profiler is not None:
+        trace_file = config['profile']
+        if trace_file is True:
+            trace_file = Path(DEFAULT_OUTPUT_ROOT) / f"{structure_name(config)}.profile.json"
+        converter.profiler.print_report()
+        converter.profiler.save(trace_file, {'input_file': str(config['INPUT_FILE'])})
+    return converter.output_dir
+
+
+def _batch_worker(config):
+    """批量转换的工作进程任务，返回(状态, 耗时, 输出目录或错误信息)"""
+    start_time = time.perf_counter()
     try:
-        # 获取用户配置
-        user_config = get_user_input()
+        # 工作进程的逐条进度输出会相互交错，批量模式下只保留汇总
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            output_dir = convert_schematic(config)
+        if config.get('verify'):
+            verify_result = verify_output(config)
+            if verify_result['mismatches']:
+                first = verify_result['samples'][0]
+                return "失败", time.perf_counter() - start_time, (
+                    f"校验发现 {verify_result['mismatches']} 格不一致，"
+                    f"首个位于 ({first['x']}, {first['y']}, {first['z']}) 源方块 {first['block']}"
+                )
+        return "成功", time.perf_counter() - start_time, str(output_dir)
+    except Exception as err:
+        return "失败", time.perf_counter() - start_time, str(err)
+
+
+def run_batch(pattern, base_config, workers=None):
+    """并行批量转换多个.schem文件，打印汇总并返回退出码"""
+    input_files = collect_schematic_files(pattern)
+    if not input_files:
+        print(f"未找到待转换的.schem文件: {pattern}")
+        return 1
+
+    results = {}
+    configs = {}
+    seen_stems = {}
+    for input_file in input_files:
+        # 输出目录按文件名区分，同名文件会互相覆盖
+        if input_file.stem in seen_stems:
+            results[input_file] = ("失败", 0.0, f"输出目录与 {seen_stems[input_file.stem]} 冲突")
+            continue
+        seen_stems[input_file.stem] = input_file
+        configs[input_file] = dict(base_config, INPUT_FILE=str(input_file), jobs=1)
+
+    print(f"开始批量转换 {len(input_files)} 个文件...")
+    batch_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        futures = {executor.submit(_batch_worker, config): input_file for input_file, config in configs.items()}
+        for future in as_completed(futures):
+            input_file = futures[future]
+            results[input_file] = future.result()
+            print(f"[{results[input_file][0]}] {input_file} ({results[input_file][1]:.2f}s)")
+
+    print("\n=== 批量转换汇总 ===")
+    name_width = max(len(str(input_file)) for input_file in input_files)
+    for input_file in input_files:
+        status, elapsed, detail = results[input_file]
+        print(f"{str(input_file):<{name_width}}  {status}  {elapsed:8.2f}s  {detail}")
+
+    failed = sum(1 for status, _, _ in results.values() if status != "成功")
+    print(f"共 {len(input_files)} 个文件，成功 {len(input_files) - failed} 个，失败 {failed} 个，"
+          f"总耗时 {time.perf_counter() - batch_start:.2f}s")
+    return 1 if failed else 0
+
+
+def split_region(region, tile_counts):
+    """把区域(x0, y0, z0, x1, y1, z1)沿X/Y/Z分别均分为tile_counts份，返回[(分块编号(ix, iy, iz), 子区域)]"""
+    axis_bounds = []
+    for axis, start, stop, count in zip("XYZ", region[:3], region[3:], tile_counts):
+        if not 1 <= count <= stop - start:
+            raise ValueError(f"{axis}轴长度为 {stop - start}，无法均分为 {count} 块")
+        axis_bounds.append([start + (stop - start) * index // count for index in range(count + 1)])
+    x_bounds, y_bounds, z_bounds = axis_bounds
+    return [
+        ((ix, iy, iz), (x_bounds[ix], y_bounds[iy], z_bounds[iz], x_bounds[ix + 1], y_bounds[iy + 1], z_bounds[iz + 1]))
+        for ix, iy, iz in itertools.product(*(range(count) for count in tile_counts))
+    ]
+
+
+def write_block_source(config, block_file):
+    """完整解码一次结构文件，把方块数据写入block_file，返回分块转换使用的block_source配置
+
+    工作进程只以内存映射方式打开block_file并复制各自的区域，不再各自解析整个结构文件。
+    总是使用流式加载，解码结果已在临时文件中时直接移动过来，不再复制一份。
+    """
+    source_config = dict(config, region=None, trim=False, state_rules=None, clean_output=None, quiet=True,
+                         loader='stream')
+    converter = SchematicConverter(source_config)
+    converter.load_schematic(config['INPUT_FILE'])
+    block_data = converter.block_data
+    converter.block_data = None
+    if isinstance(block_data, np.memmap) and block_data.filename:
+        block_data.flush()
+        spill_file = block_data.filename
+        del block_data
+        shutil.move(spill_file, block_file)
+    else:
+        with open(block_file, "wb") as writer:
+            for start in range(0, block_data.size, DEFAULT_DECODE_CHUNK):
+                block_data[start:start + DEFAULT_DECODE_CHUNK].tofile(writer)
+    return {
+        'file': str(block_file),
+        'size': (converter.width, converter.height, converter.length),
+        'palette': {block_name: palette_id for palette_id, block_name in converter.palette_names.items()}
+    }
+
 
-        converter = SchematicConverter(user_config)
-        print(f"正在解析结构文件: {user_config['INPUT_FILE']}")
-        converter.load_schematic(user_config['INPUT_FILE'])
+def run_tiles(config, tile_counts, workers=None):
+    """把结构（或config['region']）均分为若干分块并行转换，打印汇总并返回退出码
+
+    每个分块使用独立的包名(<包名>.<结构名>_tX_Y_Z)、类前缀(<类前缀>_TX_Y_Z)和输出目录，
+    工作进程的峰值内存与分块大小成正比。
+    """
+    config = {**default_config(), **config}
+    name = structure_name(config)
+    output_root = Path(config.get('output_dir') or Path(DEFAULT_OUTPUT_ROOT) / name)
+
+    with tempfile.TemporaryDirectory(prefix="schem_tiles_", ignore_cleanup_errors=True) as work_dir:
+        print(f"正在解码结构文件: {config['INPUT_FILE']}")
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            block_source = write_block_source(config, Path(work_dir) / "block_data.u32")
+        width, height, length = block_source['size']
+        input_digest = _file_digest(config['INPUT_FILE']) if config.get('cache', True) else None
+        tiles = split_region(config.get('region') or (0, 0, 0, width, height, length), tile_counts)
+
+        tile_configs = {}
+        for (ix, iy, iz), region in tiles:
+            label = f"t{ix}_{iy}_{iz}"
+            tile_configs[label] = dict(
+                config, region=list(region), block_source=block_source, input_digest=input_digest,
+                name=f"{name}_{label}", class_prefix=f"{config['class_prefix']}_{label.upper()}",
+                output_dir=str(output_root / label), jobs=1, quiet=True, clean_output=None,
+                profile=True if config.get('profile') else None
+            )
+
+        print(f"开始分块转换: {len(tiles)} 块 ({'x'.join(map(str, tile_counts))})...")
+        results = {}
+        tiles_start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            futures = {executor.submit(_batch_worker, tile_config): label for label, tile_config in tile_configs.items()}
+            for future in as_completed(futures):
+                label = futures[future]
+                results[label] = future.result()
+                print(f"[{results[label][0]}] {label} ({results[label][1]:.2f}s)")
+
+    print("\n=== 分块转换汇总 ===")
+    for label, tile_config in tile_configs.items():
+        status, elapsed, detail = results[label]
+        x0, y0, z0, x1, y1, z1 = tile_config['region']
+        print(f"{label}  ({x0}, {y0}, {z0})-({x1}, {y1}, {z1})  {tile_config['class_prefix']}  "
+              f"{status}  {elapsed:8.2f}s  {detail}")
+
+    failed = sum(1 for status, _, _ in results.values() if status != "成功")
+    print(f"共 {len(tiles)} 块，成功 {len(tiles) - failed} 块，失败 {failed} 块，"
+          f"总耗时 {time.perf_counter() - tiles_start:.2f}s")
+    return 1 if failed else 0
+
+
+def parse_int_tuple(text, lengths):
+    """解析逗号分隔的整数列表（命令行参数类型），元素个数须在lengths中"""
+    try:
+        values = tuple(int(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无法解析整数列表: {text}")
+    if len(values) not in lengths:
+        raise argparse.ArgumentTypeError(f"需要 {' 或 '.join(map(str, lengths))} 个整数: {text}")
+    return values
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="将.schem结构文件转换为GTCEu多方块Java代码")
+    parser.add_argument("--input", metavar="文件",
+                        help="非交互转换单个结构文件，配置取自--config（未指定时使用默认配置）")
+    parser.add_argument("--output-dir", metavar="目录",
+                        help="单文件模式的输出目录（默认: multiblock/<结构名>）")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="并行生成Part文件的进程数，0表示使用全部CPU核心（默认: 1）")
+    parser.add_argument("--batch", metavar="目录或通配符",
+                        help="非交互批量转换指定目录下（或匹配通配符）的全部.schem文件")
+    parser.add_argument("--watch", metavar="目录或通配符",
+                        help="监视目录（或匹配通配符）中的结构文件，变化后在常驻进程中增量重新转换")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_WATCH_INTERVAL,
+                        help=f"监视模式的轮询间隔（秒，默认: {DEFAULT_WATCH_INTERVAL}）")
+    parser.add_argument("--config", metavar="配置文件",
+                        help="JSON/TOML配置文件，提供包名、类前缀、特殊字符、复杂条件与每个Part的层数等")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="批量或分块转换的工作进程数，0表示使用全部CPU核心（默认: 0）")
+    parser.add_argument("--quiet", action="store_true",
+                        help="静默模式，不逐条打印调色板映射")
+    parser.add_argument("--loader", choices=["auto", "nbtlib", "stream"], default="auto",
+                        help="NBT加载方式：stream为流式内存映射加载，auto按文件大小自动选择（默认: auto）")
+    parser.add_argument("--strip-states", action="store_true",
+                        help="转换前在内存中移除全部方块状态并合并重复方块（配置文件中可用state_rules指定保留的状态）")
+    parser.add_argument("--clean-output", metavar="文件",
+                        help="同时输出移除方块状态后的.schem文件（仅单文件模式）")
+    parser.add_argument("--layers-per-file", type=int, default=None,
+                        help="每个Part类的最大层数（默认按Java类文件限制自动计算）")
+    parser.add_argument("--output-mode", choices=OUTPUT_MODES, default=None,
+                        help="java: 层数据写成String[]常量（默认）；resource: 写成压缩资源文件和运行时加载类")
+    parser.add_argument("--region", type=lambda text: parse_int_tuple(text, (6,)), metavar="x0,y0,z0,x1,y1,z1",
+                        help="只转换结构中的一个区域（半开区间，坐标相对结构原点）")
+    parser.add_argument("--tiles", type=lambda text: parse_int_tuple(text, (1, 3)), metavar="NX[,NY,NZ]",
+                        help="把结构（或--region区域）沿X/Y/Z均分为多块并行转换，每块生成独立的包和类前缀"
+                             "（只给一个数时只沿X轴拆分）")
+    parser.add_argument("--trim", action="store_true",
+                        help="生成层数据前裁剪掉结构四周全是空气的切片")
+    parser.add_argument("--dedupe-layers", action="store_true",
+                        help="相同的层只生成一个常量，连续重复的aisle合并为.setRepeatable")
+    parser.add_argument("--profile", nargs="?", const=True, default=None, metavar="记录文件",
+                        help=f"记录各阶段耗时、CPU时间和峰值内存，打印汇总并写出JSON记录"
+                             f"（默认: {DEFAULT_OUTPUT_ROOT}/<结构名>.profile.json）")
+    parser.add_argument("--profile-cprofile", action="store_true",
+                        help="配合--profile使用，同时用cProfile剖析并转储最慢的阶段")
+    parser.add_argument("--stats", action="store_true",
+                        help="输出每个字符对应的方块及出现次数统计（<类前缀>_Stats.json）")
+    parser.add_argument("--verify", action="store_true",
+                        help="转换后把生成的层和.where()条件还原为方块，与源结构逐格校验，不一致时返回非零退出码")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="禁用构建缓存，总是重新转换")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR),
+                        help=f"构建缓存目录（默认: {DEFAULT_CACHE_DIR}）")
+    return parser.parse_args(argv)
 
-        print("生成层级数据...")
-        layers_data = converter.generate_layers()  # 修复：避免与实例变量名冲突
 
-        print("生成Java结构类...")
-        converter.generate_java_code(layers_data)
+if __name__ == "__main__":
+    args = parse_args()
 
-        print("生成主模式类和条件文件...")
-        converter.generate_pattern_code_snippet()
+    if args.batch or args.watch:
+        try:
+            batch_config = load_config_file(args.config) if args.config else default_config()
+        except (OSError, ValueError) as e:
+            print(f"读取配置文件失败: {str(e)}")
+            sys.exit(1)
+        batch_config.update(cache=not args.no_cache, cache_dir=args.cache_dir, quiet=True, loader=args.loader)
+        batch_config['trim'] = batch_config.get('trim') or args.trim
+        batch_config['dedupe_layers'] = batch_config.get('dedupe_layers') or args.dedupe_layers
+        batch_config['stats'] = batch_config.get('stats') or args.stats
+        batch_config['verify'] = args.verify
+        if args.layers_per_file:
+            batch_config['layers_per_file'] = args.layers_per_file
+        if args.output_mode:
+            batch_config['output_mode'] = args.output_mode
+        if args.profile:
+            # 批量模式下每个文件写出各自的默认记录文件
+            batch_config.update(profile=True, profile_cprofile=args.profile_cprofile)
+        if args.strip_states and batch_config.get('state_rules') is None:
+            batch_config['state_rules'] = {}
+        if args.watch:
+            batch_config['jobs'] = args.jobs
+            sys.exit(run_watch(args.watch, batch_config, args.poll_interval))
+        sys.exit(run_batch(args.batch, batch_config, args.workers))
 
-        print("生成完成！文件输出至: {}".format(
-            Path(DEFAULT_OUTPUT_ROOT) / Path(user_config['INPUT_FILE']).stem
-        ))
+    try:
+        # 获取用户配置：指定--input时完全由配置文件和命令行参数决定，不再逐项询问
+        if args.input:
+            user_config = load_config_file(args.config) if args.config else default_config()
+            user_config['INPUT_FILE'] = args.input
+        else:
+            user_config = get_user_input()
+        user_config.update(jobs=args.jobs, cache=not args.no_cache, cache_dir=args.cache_dir, quiet=args.quiet,
+                           loader=args.loader, clean_output=args.clean_output, profile=args.profile,
+                           profile_cprofile=args.profile_cprofile, output_dir=args.output_dir)
+        user_config['trim'] = user_config.get('trim') or args.trim
+        user_config['dedupe_layers'] = user_config.get('dedupe_layers') or args.dedupe_layers
+        user_config['stats'] = user_config.get('stats') or args.stats
+        if args.layers_per_file:
+            user_config['layers_per_file'] = args.layers_per_file
+        if args.output_mode:
+            user_config['output_mode'] = args.output_mode
+        if (args.strip_states or args.clean_output) and user_config.get('state_rules') is None:
+            user_config['state_rules'] = {}
+        if args.region:
+            user_config['region'] = list(args.region)
+        if args.tiles:
+            user_config['verify'] = args.verify
+            tile_counts = args.tiles if len(args.tiles) == 3 else (args.tiles[0], 1, 1)
+            sys.exit(run_tiles(user_config, tile_counts, args.workers))
+
+        output_dir = convert_schematic(user_config)
+
+        print("生成完成！文件输出至: {}".format(output_dir))
+        if args.verify:
+            verify_result = verify_output(user_config)
+            print_verify_report(verify_result)
+            if verify_result['mismatches']:
+                sys.exit(1)
     except Exception as e:
-        print(f"转换失败: {str(e)}")
\ No newline at end of file
+        print(f"转换失败: {str(e)}")
+        sys.exit(1)
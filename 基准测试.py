@@ -0,0 +1,283 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import nbtlib
+from nbtlib import Compound
+import numpy as np
+
+from StructuralTransformation import (
+    DEFAULT_COMPLEX_CONDITIONS, DEFAULT_SPECIAL_CHARS, TOOL_VERSION, SchematicConverter, StageProfiler,
+    default_config, encode_varint_array
+)
+
+# 默认测试规模（宽x高x长）
+DEFAULT_SIZES = ["32x32x32", "128x64x128", "256x128x256"]
+DEFAULT_PALETTE_SIZE = 64
+DEFAULT_AIR_FRACTION = 0.5
+DEFAULT_REPEAT = 3
+DEFAULT_RESULT_FILE = "benchmark.json"
+DEFAULT_REGRESSION_RATIO = 1.2  # 耗时超过基准的该倍数视为性能退化
+
+# 基准结果中列出的阶段（转换器的profiled_stage阶段名）；load_schematic包含前三个阶段
+BENCHMARK_STAGES = [
+    "_read_nbt", "decode_nbt_block_data", "parse_nbt_palette", "load_schematic",
+    "generate_layers", "generate_java_code"
+]
+
+
+def parse_size(text):
+    """解析"宽x高x长"形式的尺寸"""
+    try:
+        width, height, length = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"尺寸格式应为 宽x高x长，例如 64x32x64: {text}")
+    if min(width, height, length) <= 0:
+        raise argparse.ArgumentTypeError(f"尺寸必须为正数: {text}")
+    return width, height, length
+
+
+def synthetic_palette(palette_size):
+    """生成测试用调色板名称：空气、控制器、复杂条件方块，其余为带或不带状态的普通方块"""
+    names = ["minecraft:air"]
+    names += [config['keywords'][0] for config in DEFAULT_SPECIAL_CHARS.values()]
+    names += [config['keywords'][0] for config in DEFAULT_COMPLEX_CONDITIONS.values()]
+    for index in range(len(names), palette_size):
+        # 每三种方块中有一种带方块状态，覆盖状态处理路径
+        if index % 3 == 0:
+            names.append(f"benchmark:block_{index}[facing=north,waterlogged=false]")
+        else:
+            names.append(f"benchmark:block_{index}")
+    return names[:max(palette_size, 2)]
+
+
+def generate_synthetic_schematic(width, height, length, palette_size=DEFAULT_PALETTE_SIZE,
+                                 air_fraction=DEFAULT_AIR_FRACTION, seed=0, version=2):
+    """在内存中生成Sponge v2/v3结构，返回(nbtlib.File, 方块ID数组)
+
+    非空气方块的出现频率按1/k递减，接近真实结构中少数方块占多数的分布。
+    """
+    rng = np.random.default_rng(seed)
+    names = synthetic_palette(palette_size)
+    size = width * height * length
+
+    weights = 1.0 / np.arange(1, len(names))
+    block_ids = rng.choice(np.arange(1, len(names), dtype=np.uint32), size=size, p=weights / weights.sum())
+    block_ids[rng.random(size) < air_fraction] = 0
+
+    palette = Compound({name: nbtlib.Int(index) for index, name in enumerate(names)})
+    block_data = nbtlib.ByteArray(encode_varint_array(block_ids).view(np.int8))
+    dimensions = {
+        'Width': nbtlib.Short(width), 'Height': nbtlib.Short(height), 'Length': nbtlib.Short(length)
+    }
+    if version == 3:
+        root = Compound({'Schematic': Compound({
+            'Version': nbtlib.Int(3), **dimensions,
+            'Blocks': Compound({'Palette': palette, 'Data': block_data})
+        })})
+    else:
+        root = Compound({
+            'Version': nbtlib.Int(2), 'PaletteMax': nbtlib.Int(len(names)), **dimensions,
+            'Palette': palette, 'BlockData': block_data
+        })
+    return nbtlib.File(root, gzipped=True), block_ids
+
+
+def stage_totals(records):
+    """汇总StageProfiler的记录，返回(阶段 -> 累计耗时, 阶段 -> 峰值内存)"""
+    seconds = {}
+    peak_bytes = {}
+    for record in records:
+        stage = record['stage']
+        seconds[stage] = seconds.get(stage, 0.0) + record['wall_seconds']
+        if 'peak_bytes' in record:
+            peak_bytes[stage] = max(peak_bytes.get(stage, 0), record['peak_bytes'])
+    return seconds, peak_bytes
+
+
+def run_pipeline(schematic_file, work_dir, config, trace_memory=False):
+    """在临时目录中完整运行一次转换流水线，返回记录了各阶段的StageProfiler"""
+    profiler = StageProfiler(trace_memory=trace_memory)
+    previous_dir = os.getcwd()
+    os.chdir(work_dir)
+    # 在整个流水线开始前启动跟踪，后面阶段的峰值包含前面阶段仍然持有的内存
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            converter = SchematicConverter(dict(config, INPUT_FILE=str(schematic_file)))
+            converter.profiler = profiler
+            converter.load_schematic(str(schematic_file))
+            converter.generate_layers()
+            converter.layers = None  # 生成Java文件走流式路径，不依赖整表层数据
+            converter.generate_java_code()
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        os.chdir(previous_dir)
+    return profiler
+
+
+def benchmark_case(size, palette_size, air_fraction, seed, version, repeat, base_config, trace_memory=True):
+    """生成一个测试结构并测量各阶段耗时（取多次运行的最小值）、吞吐量和峰值内存"""
+    width, height, length = size
+    blocks = width * height * length
+    with tempfile.TemporaryDirectory(prefix="schem_bench_") as work_dir:
+        schematic, _ = generate_synthetic_schematic(width, height, length, palette_size, air_fraction, seed, version)
+        schematic_file = Path(work_dir) / f"bench_{width}x{height}x{length}.schem"
+        schematic.save(schematic_file)
+        del schematic
+
+        best_seconds = {}
+        for _ in range(repeat):
+            run_seconds, _ = stage_totals(run_pipeline(schematic_file, work_dir, base_config).records)
+            for stage, seconds in run_seconds.items():
+                best_seconds[stage] = min(best_seconds.get(stage, seconds), seconds)
+
+        # tracemalloc会明显拖慢纯Python代码，峰值内存单独运行一次测量
+        peak_bytes = {}
+        if trace_memory:
+            profiler = run_pipeline(schematic_file, work_dir, base_config, trace_memory=True)
+            _, peak_bytes = stage_totals(profiler.records)
+
+        stages = {}
+        for stage in BENCHMARK_STAGES:
+            seconds = best_seconds.get(stage)
+            if seconds is None:
+                continue
+            stages[stage] = {
+                'seconds': seconds,
+                'blocks_per_second': blocks / seconds if seconds > 0 else None,
+                'peak_bytes': peak_bytes.get(stage)
+            }
+
+        return {
+            'name': f"{width}x{height}x{length}_p{palette_size}_a{air_fraction:g}_v{version}",
+            'size': [width, height, length],
+            'blocks': blocks,
+            'palette_size': palette_size,
+            'air_fraction': air_fraction,
+            'version': version,
+            'file_bytes': schematic_file.stat().st_size,
+            'stages': stages
+        }
+
+
+def environment_info():
+    return {
+        'tool_version': TOOL_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+
+def _format_bytes(value):
+    if value is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024 or unit == "GB":
+            return f"{value:.1f}{unit}"
+        value /= 1024
+
+
+def print_results(results):
+    """打印各用例的阶段耗时、吞吐量和峰值内存"""
+    for case in results['cases']:
+        print(f"\n用例 {case['name']}（{case['blocks']} 个方块，文件 {_format_bytes(case['file_bytes'])}）")
+        print(f"  {'阶段':<24}{'耗时(秒)':>12}{'方块/秒':>16}{'峰值内存':>12}")
+        for stage, stats in case['stages'].items():
+            rate = f"{stats['blocks_per_second']:.3g}" if stats['blocks_per_second'] else "-"
+            print(f"  {stage:<24}{stats['seconds']:>12.4f}{rate:>16}{_format_bytes(stats['peak_bytes']):>12}")
+
+
+def compare_results(baseline, current, threshold=DEFAULT_REGRESSION_RATIO):
+    """逐用例逐阶段比较两次结果的耗时，返回退化的阶段列表"""
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions = []
+    print(f"\n对比基准（{baseline['environment']['timestamp']}，版本 {baseline['environment']['tool_version']}）:")
+    for case in current['cases']:
+        old_case = baseline_cases.get(case['name'])
+        if old_case is None:
+            print(f"  用例 {case['name']} 在基准中不存在，跳过")
+            continue
+        print(f"  用例 {case['name']}")
+        for stage, stats in case['stages'].items():
+            old_stats = old_case['stages'].get(stage)
+            if old_stats is None or not old_stats['seconds']:
+                continue
+            ratio = stats['seconds'] / old_stats['seconds']
+            marker = ""
+            if ratio > threshold:
+                marker = "  <-- 退化"
+                regressions.append((case['name'], stage, ratio))
+            print(f"    {stage:<24}{old_stats['seconds']:>10.4f} -> {stats['seconds']:<10.4f}x{ratio:.2f}{marker}")
+    return regressions
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as reader:
+        return json.load(reader)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="转换器各阶段的基准测试（使用内存中生成的合成结构）")
+    parser.add_argument("--size", type=parse_size, action="append",
+                        help=f"测试结构尺寸 宽x高x长，可重复指定（默认 {' '.join(DEFAULT_SIZES)}）")
+    parser.add_argument("--palette", type=int, default=DEFAULT_PALETTE_SIZE, help="调色板大小")
+    parser.add_argument("--air", type=float, default=DEFAULT_AIR_FRACTION, help="空气方块比例")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--version", type=int, choices=(2, 3), default=2, help="生成的Sponge结构版本")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="每个用例的运行次数，取最短耗时")
+    parser.add_argument("--jobs", type=int, default=1, help="生成Java文件的进程数")
+    parser.add_argument("--loader", choices=("auto", "nbtlib", "stream"), default="auto", help="NBT加载方式")
+    parser.add_argument("--no-memory", action="store_true", help="不测量峰值内存")
+    parser.add_argument("--output", default=DEFAULT_RESULT_FILE, help="结果JSON文件路径")
+    parser.add_argument("--compare", metavar="BASELINE", help="与之前保存的结果JSON比较")
+    parser.add_argument("--diff", nargs=2, metavar=("BASELINE", "CURRENT"), help="只比较两个已保存的结果JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_RATIO,
+                        help="耗时比例超过该值时判定为退化")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.diff:
+        regressions = compare_results(load_results(args.diff[0]), load_results(args.diff[1]), args.threshold)
+        return 1 if regressions else 0
+
+    base_config = default_config()
+    base_config.update(jobs=args.jobs, loader=args.loader, quiet=True)
+
+    results = {'environment': environment_info(), 'cases': []}
+    for size in args.size or [parse_size(text) for text in DEFAULT_SIZES]:
+        print(f"正在测试 {size[0]}x{size[1]}x{size[2]} ...")
+        results['cases'].append(benchmark_case(
+            size, args.palette, args.air, args.seed, args.version, args.repeat, base_config,
+            trace_memory=not args.no_memory
+        ))
+
+    print_results(results)
+    with open(args.output, "w", encoding="utf-8") as writer:
+        json.dump(results, writer, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {args.output}")
+
+    if args.compare:
+        regressions = compare_results(load_results(args.compare), results, args.threshold)
+        if regressions:
+            print(f"发现 {len(regressions)} 个阶段性能退化")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
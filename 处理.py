@@ -1,17 +1,25 @@
 import nbtlib
 from nbtlib import Compound
+import numpy as np
 import sys
 from pathlib import Path
 
+from StructuralTransformation import (
+    decode_block_data_array, encode_varint_array, strip_block_states, strip_state_name
+)
 
-def remove_block_states_from_schem(input_file, output_file=None):
+
+def remove_block_states_from_schem(input_file, output_file=None, verbose=False, keep_rules=None):
     """
     从.schem文件中删除Palette中每个方块ID后面的方括号及其内容（方块状态数据）
-    如果出现重复的基本方块ID，只保留第一次出现的数字索引，并将后续重复的方块ID对应的数字索引替换为第一次出现的数字索引
+    如果出现重复的基本方块ID，合并为同一个调色板条目，并压缩调色板使索引保持连续
+    BlockData按varint解码后通过一次查找表索引完成重映射，再重新编码为varint字节数组
 
     参数:
         input_file: 输入的.schem文件路径
         output_file: 输出的.schem文件路径，如果为None则覆盖原文件
+        verbose: 是否逐条打印调色板映射
+        keep_rules: 方块状态保留规则{通配符: 保留的状态名列表}，None表示移除全部状态
     """
     try:
         # 确定输出文件路径
@@ -28,65 +36,30 @@ def remove_block_states_from_schem(input_file, output_file=None):
         # 获取Palette
         palette = nbt_file['Palette']
 
-        # 获取BlockData
-        block_data = nbt_file['BlockData']
-
-        # 创建一个新的Palette，移除方块状态数据
-        new_palette = Compound()
-        # 用于记录基本方块ID和对应的第一次出现的数字索引
-        base_id_to_index = {}
-        # 用于记录需要替换的索引映射关系
-        index_mapping = {}
-        removed_count = 0
-        duplicate_count = 0
-
-        # 第一次遍历：处理Palette，构建新Palette和索引映射
-        for block_id_with_states, index in palette.items():
-            # 提取基本方块ID（移除方括号及其内容）
-            if '[' in block_id_with_states:
-                base_block_id = block_id_with_states.split('[')[0]
-                removed_count += 1
-            else:
-                base_block_id = block_id_with_states
-
-            # 检查基本方块ID是否已经存在
-            if base_block_id in base_id_to_index:
-                # 记录索引映射关系：将当前索引映射到第一次出现的索引
-                first_index = base_id_to_index[base_block_id]
-                index_mapping[index] = first_index
-                print(f"发现重复方块ID: {base_block_id}, 将索引 {index} 映射到 {first_index}")
-                duplicate_count += 1
-            else:
-                # 第一次出现这个基本方块ID，记录它
-                base_id_to_index[base_block_id] = index
-                new_palette[base_block_id] = index
-                print(f"添加方块ID: {base_block_id} -> {index}")
-
-        # 第二次遍历：更新BlockData中的索引
-        if index_mapping:
-            print(f"开始更新BlockData中的索引映射...")
-            # 将BlockData转换为列表以便修改
-            block_data_list = list(block_data)
-
-            for i in range(len(block_data_list)):
-                current_index = block_data_list[i]
-                if current_index in index_mapping:
-                    block_data_list[i] = index_mapping[current_index]
-
-            # 将修改后的列表转换回nbtlib的IntArray
-            nbt_file['BlockData'] = nbtlib.IntArray(block_data_list)
-            print(f"更新了BlockData中的 {len([x for x in block_data_list if x in index_mapping])} 个索引")
-
-        # 更新Palette
-        nbt_file['Palette'] = new_palette
-
-        # 使用上下文管理器自动保存
-        with nbt_file as file_obj:
-            # 在上下文管理器中使用文件对象
-            pass
-
-        print(f"处理完成！移除了 {removed_count} 个方块的状态数据")
-        print(f"处理了 {duplicate_count} 个重复的方块ID")
+        # 解码BlockData（varint字节数组或整数数组）
+        expected_size = int(nbt_file['Width']) * int(nbt_file['Height']) * int(nbt_file['Length'])
+        block_data = decode_block_data_array(nbt_file['BlockData'], expected_size)
+
+        # 构建紧凑的新Palette，并用查找表原地重映射BlockData
+        new_palette, new_block_data, stats = strip_block_states(palette.items(), block_data, keep_rules,
+                                                                out=block_data)
+
+        if verbose:
+            for block_id_with_states, index in sorted(palette.items(), key=lambda item: int(item[1])):
+                base_block_id = strip_state_name(block_id_with_states, keep_rules)
+                print(f"映射方块ID: {block_id_with_states} ({index}) -> {base_block_id} ({new_palette[base_block_id]})")
+
+        nbt_file['Palette'] = Compound({name: nbtlib.Int(index) for name, index in new_palette.items()})
+        if 'PaletteMax' in nbt_file:
+            nbt_file['PaletteMax'] = nbtlib.Int(len(new_palette))
+        nbt_file['BlockData'] = nbtlib.ByteArray(encode_varint_array(new_block_data).view(np.int8))
+        print(f"更新了BlockData中的 {stats['merged_blocks']} 个索引")
+
+        # 保存到输出路径
+        nbt_file.save(output_path)
+
+        print(f"处理完成！移除了 {stats['stripped']} 个方块的状态数据")
+        print(f"处理了 {stats['duplicates']} 个重复的方块ID，调色板压缩为 {stats['palette_size']} 项")
         print(f"输出文件: {output_path}")
 
     except Exception as e: